@@ -0,0 +1,37 @@
+import itertools
+import math
+
+import numpy as np
+import pytest
+
+import test_rag
+
+# Every cascade threshold, a hair either side of it, and non-finite values
+SCORES = [
+    0.0, 0.39, 0.3999999, 0.4, 0.4000001, 0.41, 0.5,
+    0.59, 0.5999999, 0.6, 0.6000001, 1.0,
+    -0.1, 1.1, math.nan, math.inf, -math.inf
+]
+TURNS = [0, 1, 2, 3, 10]
+GRID = list(itertools.product(SCORES, SCORES, TURNS))
+
+
+def test_decide_mode_matches_cascade():
+    for gap, conf, turns in GRID:
+        expected = test_rag.HEURISTIC_RULES[test_rag._heuristic_cascade(gap, conf, turns)]
+        assert test_rag.decide_mode(gap, conf, turns) == expected, (gap, conf, turns)
+
+
+def test_decide_modes_batch_matches_cascade():
+    gap, conf, turns = (list(col) for col in zip(*GRID))
+    rules = test_rag.decide_modes_batch(gap, conf, turns)
+    expected = np.array([test_rag._heuristic_cascade(*row) for row in GRID])
+    assert (rules == expected).all()
+
+
+@pytest.mark.parametrize("value", ["NaN", "nan", "inf", "-Infinity"])
+def test_heuristic_request_rejects_non_finite(value):
+    with pytest.raises(ValueError):
+        test_rag.HeuristicRequest.from_body(
+            {"gap_score": 0.7, "confidence_score": value, "turns_so_far": 2}
+        )
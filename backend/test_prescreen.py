@@ -0,0 +1,37 @@
+import json
+
+import test_rag
+
+
+def _reference_answers():
+    with open(test_rag.QUESTION_BANK_SEED_PATH, encoding="utf-8") as f:
+        rows = json.load(f)
+
+    for row in rows:
+        phase = "probe" if row.get("type") == "probe" else "base"
+        for answer in row.get("reference_answers") or []:
+            yield phase, row["question"], answer
+
+
+def test_seed_reference_answers_are_never_short_circuited():
+    failures = [
+        (phase, question, answer, verdict)
+        for phase, question, answer in _reference_answers()
+        for verdict in [test_rag._prescreen_verdict(question, answer, phase)]
+        if verdict
+    ]
+    assert failures == []
+
+
+def test_one_word_answers():
+    question = "What values appear in the B columns for a row of A that has no match?"
+    assert test_rag._prescreen_verdict(question, "NULL", "probe") is None
+    assert test_rag._prescreen_verdict(question, "NULL", "base") == "too_short"
+    assert test_rag._prescreen_verdict(question, "", "probe") == "too_short"
+
+
+def test_copy_of_question():
+    question = test_rag.JOIN_FALLBACK_QUESTION
+    assert test_rag._prescreen_verdict(question, question) == "copy_of_question"
+    assert test_rag._prescreen_verdict(question, question.upper(), "probe") == "copy_of_question"
+    assert test_rag._prescreen_verdict(question, "rows 1 and 2 appear") is None
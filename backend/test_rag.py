@@ -1,14 +1,55 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from dataclasses import dataclass
+import asyncio
+import cProfile
+import functools
+import gzip
+import hashlib
+import hmac
+import io
 import json
+import marshal
+import math
+import os
+import pstats
+import random
+import re
 import requests
 import sys
+import threading
+import time
+import traceback
+import zlib
+import numpy as np
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+try:
+    import orjson
+except ImportError:   # optional speed-up; stdlib json is the fallback
+    orjson = None
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 
 
 # Script initialization message
 print("LOADED: rag_api.py")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    """Runs the registered maintenance jobs (see BACKGROUND MAINTENANCE) while serving."""
+    tasks = [asyncio.create_task(_maintenance_loop(interval, job)) for interval, job in MAINTENANCE_JOBS]
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # ===========================
 # CONFIG
@@ -33,6 +74,13 @@ LOGGER_AGENT_URL = "https://api.on-demand.io/automation/api/workflow/696ae8888e6
 
 LOGGER_RESULTS = {}
 
+# Session replay swaps in the agent stub process-wide and holds the event
+# loop for the whole run, so it is only served by offline instances
+REPLAY_ENABLED = os.environ.get("FUD_REPLAY_ENABLED") == "1"
+
+# Shared secret for the /admin endpoints (X-Admin-Token); unset → disabled
+ADMIN_TOKEN = os.environ.get("FUD_ADMIN_TOKEN", "")
+
 
 # ===========================
 # GLOBAL STATE (demo-scoped)
@@ -46,6 +94,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Negotiated per request via Accept-Encoding; small bodies are sent as-is
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Maintains the current phase and data for the exam session
 
 STATE = {
@@ -58,7 +109,11 @@ STATE = {
     "stability_result": None,
      "followup_question": None,
     "followup_type": None,
-    "probe_count": 0
+    "probe_count": 0,
+    "session_id": None,
+    "phase_version": 0,       # bumped by set_phase()
+    "phase_started": None,    # (wall, perf) clock of the current phase, for tracing
+    "awaiting": {}            # webhook name → phase_version it was requested at
 }
 
 # ===========================
@@ -110,6 +165,15 @@ def safe_parse_json(raw: str):
     if "{" not in raw or "}" not in raw:
         return None
 
+    # Fast path: already-clean JSON objects
+    if raw[0] == "{":
+        try:
+            parsed = json_loads(raw)
+            if isinstance(parsed, dict):
+                return parsed
+        except Exception:
+            pass
+
     try:
         start = raw.index("{")
         end = raw.rindex("}") + 1
@@ -119,6 +183,1023 @@ def safe_parse_json(raw: str):
     except Exception:
         return None
     
+# ===========================
+# REQUEST / RESPONSE CODEC
+# ===========================
+# One tolerant parse per request (JSON value, else decoded text) and one
+# fast serialize per response. orjson is used when installed.
+
+def json_loads(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def json_dumps_bytes(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with the shared codec."""
+
+    def render(self, content) -> bytes:
+        try:
+            return json_dumps_bytes(content)
+        except TypeError:
+            return json.dumps(jsonable_encoder(content), separators=(",", ":")).encode()
+
+
+def json_endpoint(handler):
+    """
+    Serializes a handler's plain return value with FastJSONResponse,
+    skipping FastAPI's generic jsonable_encoder pass.
+    Responses returned by the handler are passed through untouched.
+    """
+    def encode(result):
+        return result if isinstance(result, Response) else FastJSONResponse(result)
+
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            return encode(await handler(*args, **kwargs))
+    else:
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            return encode(handler(*args, **kwargs))
+
+    return wrapper
+
+
+_BODY_UNSET = object()
+
+
+async def parse_body(request: Request):
+    """
+    Parses the request body once per request.
+    Returns the JSON value, or the decoded text when it isn't JSON.
+    Aliases and internal delegation reuse the cached result.
+    """
+    cached = getattr(request.state, "parsed_body", _BODY_UNSET)
+    if cached is not _BODY_UNSET:
+        return cached
+
+    raw = decode_content(await request.body(), request.headers.get("content-encoding"))
+    try:
+        body = json_loads(raw)
+    except Exception:
+        body = raw.decode(errors="ignore")
+
+    request.state.parsed_body = body
+    return body
+
+
+async def parse_webhook(request: Request):
+    """Webhook variant: clean JSON objects take the fast path, noisy ones go through safe_parse_json."""
+    body = await parse_body(request)
+    if isinstance(body, dict):
+        return body
+    return safe_parse_json(body) if isinstance(body, str) else None
+
+
+# -------- Payload compression --------
+# Responses: GZipMiddleware (see app setup). Requests: gzip/deflate bodies
+# are inflated in parse_body. Outbound: agent payloads above the threshold
+# are gzipped for upstreams listed in COMPRESSED_UPSTREAMS.
+
+MAX_INFLATED_BODY_BYTES = 64 * 1024 * 1024
+OUTBOUND_COMPRESS_MIN_BYTES = 8192
+
+# Only upstreams known to accept Content-Encoding: gzip. Our own follow-up
+# endpoints do (parse_body); add OnDemand workflows once confirmed.
+COMPRESSED_UPSTREAMS = {
+    "http://127.0.0.1:8000/generate/mcq",
+    "http://127.0.0.1:8000/generate/text"
+}
+
+COMPRESSION_STATS = {
+    "inbound_bodies": 0,
+    "inbound_wire_bytes": 0,
+    "inbound_inflated_bytes": 0,
+    "outbound_payloads": 0,
+    "outbound_raw_bytes": 0,
+    "outbound_wire_bytes": 0
+}
+
+
+def decode_content(raw: bytes, encoding) -> bytes:
+    """Inflates gzip/deflate request bodies, refusing anything past the size cap."""
+    if not encoding or not raw:
+        return raw
+
+    encoding = encoding.strip().lower()
+    if encoding == "gzip":
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        inflater = zlib.decompressobj()
+    else:
+        return raw
+
+    try:
+        inflated = inflater.decompress(raw, MAX_INFLATED_BODY_BYTES)
+    except zlib.error:
+        raise HTTPException(400, f"Invalid {encoding} request body")
+
+    if inflater.unconsumed_tail:
+        raise HTTPException(413, "Inflated request body too large")
+
+    COMPRESSION_STATS["inbound_bodies"] += 1
+    COMPRESSION_STATS["inbound_wire_bytes"] += len(raw)
+    COMPRESSION_STATS["inbound_inflated_bytes"] += len(inflated)
+    return inflated
+
+
+def compress_outbound(url: str, payload, headers):
+    """
+    Returns (data, headers) for a gzipped agent payload, or None when the
+    upstream doesn't accept gzip or the payload is below the threshold.
+    """
+    if url not in COMPRESSED_UPSTREAMS or payload is None:
+        return None
+
+    data = json_dumps_bytes(payload)
+    if len(data) < OUTBOUND_COMPRESS_MIN_BYTES:
+        return None
+
+    wire = gzip.compress(data, compresslevel=5)
+    COMPRESSION_STATS["outbound_payloads"] += 1
+    COMPRESSION_STATS["outbound_raw_bytes"] += len(data)
+    COMPRESSION_STATS["outbound_wire_bytes"] += len(wire)
+
+    return wire, {
+        **(headers or {}),
+        "Content-Type": "application/json",
+        "Content-Encoding": "gzip"
+    }
+
+
+@app.get("/compression/stats")
+@json_endpoint
+def compression_stats():
+    """Bytes on the wire vs. inflated for compressed exchanges."""
+    stats = COMPRESSION_STATS
+    return {
+        **stats,
+        "inbound_ratio": (
+            stats["inbound_wire_bytes"] / stats["inbound_inflated_bytes"]
+            if stats["inbound_inflated_bytes"] else None
+        ),
+        "outbound_ratio": (
+            stats["outbound_wire_bytes"] / stats["outbound_raw_bytes"]
+            if stats["outbound_raw_bytes"] else None
+        )
+    }
+
+
+# -------- Typed request schemas --------
+# from_body() keeps each endpoint's existing tolerant string-or-dict rules.
+
+@dataclass(slots=True)
+class ChatRequest:
+    user_input: str
+    session_id: str = "anonymous"
+
+    @classmethod
+    def from_body(cls, body):
+        if isinstance(body, str):
+            return cls(body.strip())
+        if isinstance(body, dict):
+            return cls(body.get("user_input", ""), body.get("session_id", "anonymous"))
+        return None
+
+
+@dataclass(slots=True)
+class MediaRequest:
+    text: str
+
+    @classmethod
+    def from_body(cls, body):
+        # Case 1: raw string
+        if isinstance(body, str):
+            return cls(body.strip())
+
+        # Case 2: structured media payload
+        if isinstance(body, dict):
+            text = (
+                body.get("text")
+                or body.get("raw_text")
+                or body.get("content")
+                or body.get("transcript")
+                or ""
+            )
+
+            if isinstance(text, list):
+                text = "\n".join(
+                    str(x) for x in text if isinstance(x, (str, int, float))
+                )
+
+            if not isinstance(text, str):
+                text = str(text)
+
+            return cls(text.strip())
+
+        return cls(str(body).strip())
+
+
+@dataclass(slots=True)
+class AnswerRequest:
+    answer: str
+
+    @classmethod
+    def from_body(cls, body):
+        if isinstance(body, str):
+            return cls(body.strip())
+        if isinstance(body, dict):
+            return cls(body.get("answer", ""))
+        return cls("")
+
+
+@dataclass(slots=True)
+class HeuristicRequest:
+    gap_score: float
+    confidence_score: float
+    turns_so_far: int
+
+    @classmethod
+    def from_body(cls, body):
+        """Raises on invalid inputs so callers can report the reason."""
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+        return cls.from_row(
+            body.get("gap_score", 0.0),
+            body.get("confidence_score", 0.0),
+            body.get("turns_so_far", 0)
+        )
+
+    @classmethod
+    def from_row(cls, gap_score, confidence_score, turns_so_far):
+        gap_score = float(gap_score)
+        confidence_score = float(confidence_score)
+        # float() accepts "NaN" / "inf"; the thresholds don't
+        if not (math.isfinite(gap_score) and math.isfinite(confidence_score)):
+            raise ValueError("non-finite score")
+        return cls(gap_score, confidence_score, int(turns_so_far))
+
+
+@dataclass(slots=True)
+class FollowupRequest:
+    """Body for /generate/mcq and /generate/text; forwarded to the agent as-is."""
+    payload: dict
+    concept: str
+    session_id: str = None
+
+    @classmethod
+    def from_body(cls, body, default=None):
+        if isinstance(body, str) and default is not None:
+            body = dict(default, base_question=body)
+        if not isinstance(body, dict):
+            return None
+        return cls(body, normalize_concept(body.get("concept")), body.get("session_id"))
+
+
+@dataclass(slots=True)
+class LoggerRequest:
+    session_id: str
+
+    @classmethod
+    def from_body(cls, body):
+        # If body is string -> treat as session_id
+        if isinstance(body, str):
+            return cls(body)
+        if isinstance(body, dict) and isinstance(body.get("session_id"), str):
+            return cls(body["session_id"])
+        return None
+
+
+@dataclass(slots=True)
+class SessionTurnRequest:
+    session_id: str
+    turn: int
+    payload: dict
+
+    @classmethod
+    def from_body(cls, body):
+        if not isinstance(body, dict):
+            return None
+        return cls(body.get("session_id"), body.get("turn"), body.get("payload"))
+
+
+@dataclass(slots=True)
+class CohortStartRequest:
+    session_ids: list
+    concepts: list
+    questions: dict
+    cohort_id: str = None
+
+    @classmethod
+    def from_body(cls, body):
+        """Raises on invalid inputs so callers can report the reason."""
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+
+        session_ids = body.get("session_ids")
+        if not isinstance(session_ids, list) or not all(isinstance(x, str) for x in session_ids):
+            raise ValueError("session_ids must be a list of strings")
+
+        concepts = body.get("concepts") or []
+        if isinstance(concepts, str):
+            concepts = [concepts]
+
+        questions = body.get("questions") or {}
+        if not isinstance(questions, dict):
+            raise ValueError("questions must map concept → question")
+
+        return cls(
+            list(dict.fromkeys(session_ids)),
+            [normalize_concept(c) for c in concepts],
+            {normalize_concept(c): q for c, q in questions.items() if isinstance(q, str)},
+            body.get("cohort_id")
+        )
+
+
+@dataclass(slots=True)
+class CohortAnswer:
+    session_id: str
+    concept: str
+    answer: str
+
+    @classmethod
+    def list_from_body(cls, body) -> list:
+        """Accepts {"answers": [...]} or a bare list; malformed rows are dropped."""
+        rows = body.get("answers") if isinstance(body, dict) else body
+        if not isinstance(rows, list):
+            return []
+
+        return [
+            cls(row["session_id"], normalize_concept(row.get("concept")), row["answer"].strip())
+            for row in rows
+            if isinstance(row, dict)
+            and isinstance(row.get("session_id"), str)
+            and isinstance(row.get("answer"), str)
+        ]
+
+
+# ===========================
+# BACKGROUND MAINTENANCE
+# ===========================
+# Periodic upkeep (expiry, compaction) that must happen even when no
+# request comes along to trigger it. Jobs run on the event loop, so they
+# share the in-memory stores with the handlers without locking.
+
+MAINTENANCE_JOBS = []       # (interval seconds, job)
+
+
+def maintenance_job(interval: float):
+    """
+    Registers job() to run every interval seconds while the app is up.
+    Coroutine jobs are awaited, so long ones can yield between batches.
+    """
+    def register(job):
+        MAINTENANCE_JOBS.append((interval, job))
+        return job
+    return register
+
+
+async def _maintenance_loop(interval: float, job) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = job()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            print("MAINTENANCE ERROR:", job.__name__, e)
+            sys.stdout.flush()
+
+
+# ===========================
+# ADMISSION CONTROL
+# ===========================
+# Token buckets in front of every paid agent call: one per session and one
+# shared bucket per agent. Casual chat may not dip into the slice of each
+# agent bucket reserved for in-progress exam steps.
+#
+# Session IDs come from the client and there is no auth, so a client can
+# rotate IDs to get a fresh session bucket each time. The session bucket
+# only keeps well-behaved clients fair to each other; the per-agent
+# buckets are what actually caps spend against OnDemand.
+
+AGENT_RATE_LIMITS = {       # agent → (tokens per second, burst)
+    "chat": (2.0, 20),
+    "question": (1.0, 10),
+    "probe": (2.0, 20),
+    "stabilizer": (2.0, 20),
+    "mcq": (2.0, 20),
+    "text": (2.0, 20)
+}
+SESSION_RATE_LIMIT = (0.5, 10)      # per session, across all agents
+EXAM_RESERVE = 0.3                  # share of each agent burst kept for exam steps
+SESSION_BUCKETS_MAX = 10000         # idle session buckets are pruned past this
+
+AGENT_URL_NAMES = {
+    CHAT_API_URL: "chat",
+    QUESTION_URL: "question",
+    PROBE_URL: "probe",
+    STABILIZER_URL: "stabilizer",
+    MCQ_AGENT_URL: "mcq",
+    TEXT_AGENT_URL: "text"
+}
+
+AGENT_BUCKETS = {}      # agent → bucket
+SESSION_BUCKETS = {}    # session_id → bucket
+
+ADMISSION_STATS = {
+    "admitted": 0,
+    "rejected_session": 0,
+    "rejected_agent": 0,
+    "rejected_chat": 0,
+    "rejected_exam": 0
+}
+
+
+def _refill(buckets: dict, key, rate: float, burst: float, now: float) -> dict:
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = {"tokens": float(burst), "updated": now}
+    else:
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+    return bucket
+
+
+def _prune_session_buckets(now: float) -> None:
+    rate, burst = SESSION_RATE_LIMIT
+    for key in [
+        k for k, b in SESSION_BUCKETS.items()
+        if b["tokens"] + (now - b["updated"]) * rate >= burst
+    ]:
+        del SESSION_BUCKETS[key]
+
+
+def admit(session_id, agent_url: str, priority: str = "exam") -> float:
+    """
+    Takes one token from the session and agent buckets.
+    Returns 0 when admitted, otherwise the seconds to wait before retrying.
+    priority is "exam" (in-progress exam step) or "chat".
+    """
+    agent = AGENT_URL_NAMES.get(agent_url)
+    if agent is None or AGENT_STUB["active"]:
+        return 0.0      # unmetered URL, or replay against the local stub
+
+    now = time.monotonic()
+    if len(SESSION_BUCKETS) > SESSION_BUCKETS_MAX:
+        _prune_session_buckets(now)
+
+    s_rate, s_burst = SESSION_RATE_LIMIT
+    a_rate, a_burst = AGENT_RATE_LIMITS[agent]
+    session = _refill(SESSION_BUCKETS, session_id or "anonymous", s_rate, s_burst, now)
+    shared = _refill(AGENT_BUCKETS, agent, a_rate, a_burst, now)
+
+    reserve = a_burst * EXAM_RESERVE if priority == "chat" else 0.0
+
+    if session["tokens"] < 1:
+        ADMISSION_STATS["rejected_session"] += 1
+        ADMISSION_STATS[f"rejected_{priority}"] += 1
+        return (1 - session["tokens"]) / s_rate
+
+    if shared["tokens"] - reserve < 1:
+        ADMISSION_STATS["rejected_agent"] += 1
+        ADMISSION_STATS[f"rejected_{priority}"] += 1
+        return (1 + reserve - shared["tokens"]) / a_rate
+
+    session["tokens"] -= 1
+    shared["tokens"] -= 1
+    ADMISSION_STATS["admitted"] += 1
+    return 0.0
+
+
+def shed_response(retry_after: float) -> Response:
+    """429 with a Retry-After hint for shed requests."""
+    seconds = max(1, int(retry_after + 0.999))
+    return FastJSONResponse(
+        {"ok": False, "status": "overloaded", "retry_after": seconds},
+        status_code=429,
+        headers={"Retry-After": str(seconds)}
+    )
+
+
+@app.get("/admission/stats")
+@json_endpoint
+def admission_stats():
+    """
+    Admission counters and current agent bucket levels. Session buckets are
+    keyed on client-supplied IDs, so only the agent buckets bound an
+    unauthenticated client.
+    """
+    return {
+        **ADMISSION_STATS,
+        "agents": {
+            agent: round(bucket["tokens"], 2)
+            for agent, bucket in AGENT_BUCKETS.items()
+        },
+        "sessions_tracked": len(SESSION_BUCKETS)
+    }
+
+
+# ===========================
+# WEBHOOK IDEMPOTENCY
+# ===========================
+# OnDemand may retry deliveries. Each delivery is keyed on its execution ID
+# (or a body hash), remembered for a bounded TTL, and retries are answered
+# from that record. Phase changes driven by webhooks are additionally
+# guarded by STATE["phase_version"], so late duplicates that outlive the
+# TTL cannot re-run a transition either.
+
+WEBHOOK_DEDUP_TTL = 600             # seconds
+WEBHOOK_DEDUP_MAX_ENTRIES = 4096
+
+WEBHOOK_DELIVERIES = OrderedDict()  # key → (expires_at, response)
+
+WEBHOOK_STATS = {
+    "processed": 0,
+    "duplicates": 0,
+    "stale": 0
+}
+
+
+def set_phase(phase: str) -> None:
+    """Every phase transition bumps the version used by webhook guards and closes a trace span."""
+    _close_phase_span()
+    STATE["phase"] = phase
+    STATE["phase_version"] += 1
+    STATE["phase_started"] = (time.time(), time.perf_counter())
+
+
+def expect_webhook(name: str) -> None:
+    """Records that a webhook is due for the current phase version."""
+    STATE["awaiting"][name] = STATE["phase_version"]
+
+
+def webhook_is_current(name: str) -> bool:
+    """
+    False when the phase moved on since the matching request was sent,
+    i.e. the delivery is a late retry. Deliveries we never asked for keep
+    the old accept-everything behaviour. Replay (agent stub active) drives
+    the flow directly and is never guarded.
+    """
+    if AGENT_STUB["active"] or name not in STATE["awaiting"]:
+        return True
+
+    if STATE["awaiting"][name] != STATE["phase_version"]:
+        WEBHOOK_STATS["stale"] += 1
+        return False
+
+    # Consumed: later deliveries are unrequested again. Retries of this one
+    # are caught by the execution-ID / body-hash de-duplication instead.
+    del STATE["awaiting"][name]
+    return True
+
+
+async def webhook_dedup_key(name: str, request: Request, payload, by_execution_id=True):
+    """
+    (webhook, execution ID) when available, else (webhook, body hash).
+    None during replay: recorded deliveries repeat by design.
+    """
+    if AGENT_STUB["active"]:
+        return None
+
+    if by_execution_id and isinstance(payload, dict):
+        execution_id = payload.get("executionID") or payload.get("execution_id")
+        if execution_id:
+            return (name, str(execution_id))
+
+    return (name, hashlib.sha1(await request.body()).hexdigest())
+
+
+def webhook_seen(key):
+    """Returns the remembered response for a duplicate delivery, or None."""
+    if key is None:
+        return None
+
+    entry = WEBHOOK_DELIVERIES.get(key)
+    if entry is None:
+        return None
+
+    if entry[0] < time.monotonic():
+        del WEBHOOK_DELIVERIES[key]
+        return None
+
+    WEBHOOK_STATS["duplicates"] += 1
+    return entry[1]
+
+
+def webhook_remember(key, response):
+    if key is None:
+        return response
+
+    WEBHOOK_DELIVERIES[key] = (time.monotonic() + WEBHOOK_DEDUP_TTL, response)
+    WEBHOOK_DELIVERIES.move_to_end(key)
+    WEBHOOK_STATS["processed"] += 1
+
+    while len(WEBHOOK_DELIVERIES) > WEBHOOK_DEDUP_MAX_ENTRIES:
+        WEBHOOK_DELIVERIES.popitem(last=False)
+
+    return response
+
+
+@app.get("/webhooks/stats")
+@json_endpoint
+def webhook_stats():
+    """Delivery de-duplication counters."""
+    return {**WEBHOOK_STATS, "tracked": len(WEBHOOK_DELIVERIES)}
+
+
+# ===========================
+# EXAM TRACING
+# ===========================
+# Lightweight spans for every phase (set_phase) and every agent call
+# (post_agent), correlated by session and execution ID.
+
+TRACE_MAX_SPANS = 500           # per session timeline
+TRACE_MAX_SESSIONS = 5000       # least recently traced sessions are dropped
+TRACE_WINDOW = 1000             # recent samples kept per span name
+
+TRACES = OrderedDict()          # session_id → deque of spans
+TRACE_ROLLING = {}              # "kind:name" → deque of durations (ms)
+
+_EXECUTION_ID_RE = re.compile(r'"executionID"\s*:\s*"([^"]+)"')
+
+
+def record_span(kind: str, name: str, started_at: float, duration_ms: float,
+                session_id=None, execution_id=None, **attrs) -> None:
+    """Appends a finished span to the session timeline and rolling aggregates."""
+    if AGENT_STUB["active"]:
+        return      # replay timings are reported by /session/replay itself
+
+    session_id = session_id or STATE.get("session_id") or "anonymous"
+
+    span = {
+        "kind": kind,
+        "name": name,
+        "started_at": started_at,
+        "duration_ms": duration_ms
+    }
+    if execution_id:
+        span["execution_id"] = execution_id
+    if attrs:
+        span.update(attrs)
+
+    timeline = TRACES.get(session_id)
+    if timeline is None:
+        timeline = TRACES[session_id] = deque(maxlen=TRACE_MAX_SPANS)
+        while len(TRACES) > TRACE_MAX_SESSIONS:
+            TRACES.popitem(last=False)
+    else:
+        TRACES.move_to_end(session_id)
+    timeline.append(span)
+
+    key = f"{kind}:{name}"
+    window = TRACE_ROLLING.get(key)
+    if window is None:
+        window = TRACE_ROLLING[key] = deque(maxlen=TRACE_WINDOW)
+    window.append(duration_ms)
+
+
+def _close_phase_span() -> None:
+    """Records how long the exam sat in the phase that is ending."""
+    started = STATE.get("phase_started")
+    if started is None:
+        return
+
+    wall_start, perf_start = started
+    record_span(
+        "phase",
+        STATE["phase"],
+        wall_start,
+        (time.perf_counter() - perf_start) * 1000,
+        version=STATE["phase_version"]
+    )
+
+
+def traced_agent_post(url: str, json=None, headers=HEADERS):
+    """post_agent body wrapped in an agent span."""
+    wall_start = time.time()
+    perf_start = time.perf_counter()
+    response = None
+
+    try:
+        response = _post_agent_untraced(url, json, headers)
+        return response
+    finally:
+        record_agent_span(url, json, wall_start, perf_start, response)
+
+
+def record_agent_span(url: str, json, wall_start: float, perf_start: float, response) -> None:
+    """Records one agent call; response is None when the call raised."""
+    status = getattr(response, "status_code", None)
+    execution_id = None
+    if status is not None:
+        match = _EXECUTION_ID_RE.search(response.text or "")
+        execution_id = match.group(1) if match else None
+
+    record_span(
+        "agent",
+        AGENT_URL_NAMES.get(url) or url.rsplit("/", 2)[-2] + "/" + url.rsplit("/", 1)[-1],
+        wall_start,
+        (time.perf_counter() - perf_start) * 1000,
+        session_id=(json or {}).get("session_id") if isinstance(json, dict) else None,
+        execution_id=execution_id,
+        status=status
+    )
+
+
+@app.get("/trace/summary")
+@json_endpoint
+def trace_summary():
+    """Rolling latency aggregates per phase and agent, largest share of wall time first."""
+    rows = []
+    for key, window in TRACE_ROLLING.items():
+        values = np.fromiter(window, dtype=np.float64, count=len(window))
+        kind, name = key.split(":", 1)
+        rows.append({
+            "kind": kind,
+            "name": name,
+            "count": int(len(values)),
+            "total_ms": float(values.sum()),
+            "mean_ms": float(values.mean()),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95))
+        })
+
+    for kind in ("phase", "agent"):
+        total = sum(r["total_ms"] for r in rows if r["kind"] == kind)
+        for r in rows:
+            if r["kind"] == kind:
+                r["share"] = r["total_ms"] / total if total else 0.0
+
+    rows.sort(key=lambda r: r["total_ms"], reverse=True)
+    dominant = next((r["name"] for r in rows if r["kind"] == "phase"), None)
+
+    return {"dominant_phase": dominant, "spans": rows}
+
+
+@app.get("/trace/{session_id}")
+@json_endpoint
+def get_trace(session_id: str):
+    """Timeline of phase and agent spans for one session."""
+    spans = sorted(TRACES.get(session_id, ()), key=lambda s: s["started_at"])
+
+    phase_totals = {}
+    for span in spans:
+        if span["kind"] == "phase":
+            phase_totals[span["name"]] = phase_totals.get(span["name"], 0.0) + span["duration_ms"]
+
+    return {
+        "session_id": session_id,
+        "spans": spans,
+        "phase_totals_ms": phase_totals
+    }
+
+
+# ===========================
+# PROFILER (OPT-IN)
+# ===========================
+# Off by default; while off the middleware is a single dict lookup.
+# When on:
+#   - requests are cProfiled when they send "X-Profile: 1" or win the
+#     sample_rate draw; stats are aggregated across requests
+#   - a watchdog thread reports event-loop stalls longer than
+#     block_threshold_ms together with the loop thread's stack
+#
+# What the profile covers: cProfile hooks the event-loop thread from the
+# middleware's start to finish, so
+#   - while a profiled request awaits, whatever else the loop runs (other
+#     requests, background tasks) lands in the same profile
+#   - sync (def) handlers and asyncio.to_thread work run in the threadpool
+#     and are NOT captured; only their dispatch and the await show up
+# Read it as "where the loop spent its time while this request was open",
+# and use the blocking report for stalls. Admin endpoints need X-Admin-Token.
+
+PROFILER = {
+    "enabled": False,
+    "sample_rate": 0.0,
+    "block_threshold_ms": 100,
+    "busy": False,              # cProfile allows one active profiler per thread
+    "stats": None,              # aggregated pstats.Stats
+    "profiled": {},             # path → profiled request count
+    "heartbeat": 0.0,
+    "loop_thread": None,
+    "generation": 0,            # bumped per start; older heartbeat / watchdog runs exit
+    "watchdog_stop": None       # threading.Event that wakes the current watchdog on stop
+}
+
+PROFILE_HEADER = b"x-profile"
+BLOCKING_EVENTS = deque(maxlen=200)
+
+
+class ProfilerMiddleware:
+    """ASGI middleware that profiles sampled requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not PROFILER["enabled"] or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        wanted = (
+            dict(scope.get("headers") or ()).get(PROFILE_HEADER) == b"1"
+            or random.random() < PROFILER["sample_rate"]
+        )
+        if not wanted or PROFILER["busy"]:
+            return await self.app(scope, receive, send)
+
+        PROFILER["busy"] = True
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return await self.app(scope, receive, send)
+        finally:
+            profile.disable()
+            PROFILER["busy"] = False
+            if PROFILER["stats"] is None:
+                PROFILER["stats"] = pstats.Stats(profile)
+            else:
+                PROFILER["stats"].add(profile)
+            path = scope.get("path", "")
+            PROFILER["profiled"][path] = PROFILER["profiled"].get(path, 0) + 1
+
+
+app.add_middleware(ProfilerMiddleware)
+
+
+def require_admin(request: Request) -> None:
+    """Rejects admin calls without the shared secret (all of them if none is set)."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, "Admin endpoints are disabled; set FUD_ADMIN_TOKEN")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(401, "Invalid admin token")
+
+
+def _profiler_current(generation: int) -> bool:
+    return PROFILER["enabled"] and PROFILER["generation"] == generation
+
+
+def _loop_heartbeat(loop, generation: int) -> None:
+    if not _profiler_current(generation):
+        return
+    PROFILER["heartbeat"] = time.perf_counter()
+    loop.call_later(PROFILER["block_threshold_ms"] / 4000, _loop_heartbeat, loop, generation)
+
+
+def _blocking_watchdog(generation: int, stop: threading.Event) -> None:
+    """Runs in a daemon thread; samples the loop thread's stack during stalls."""
+    current = None   # (heartbeat, event) of the stall being reported
+
+    while _profiler_current(generation):
+        threshold = PROFILER["block_threshold_ms"] / 1000
+
+        # Stopped (or stopped and restarted) while waiting
+        if stop.wait(threshold / 2) or not _profiler_current(generation):
+            return
+
+        heartbeat = PROFILER["heartbeat"]
+        lag = time.perf_counter() - heartbeat
+        if lag < threshold:
+            current = None
+            continue
+
+        if current is not None and current[0] == heartbeat:
+            current[1]["blocked_ms"] = lag * 1000   # same stall, still going
+            continue
+
+        frame = sys._current_frames().get(PROFILER["loop_thread"])
+        event = {
+            "detected_at": time.time(),
+            "blocked_ms": lag * 1000,
+            "stack": traceback.format_stack(frame) if frame else []
+        }
+        BLOCKING_EVENTS.append(event)
+        current = (heartbeat, event)
+
+
+@app.post("/admin/profile/start")
+@json_endpoint
+async def start_profiler(request: Request):
+    """Turns profiling on. Body: {sample_rate, block_threshold_ms} (both optional)."""
+    require_admin(request)
+    body = await parse_body(request)
+    body = body if isinstance(body, dict) else {}
+
+    try:
+        PROFILER["sample_rate"] = min(1.0, max(0.0, float(body.get("sample_rate", PROFILER["sample_rate"]))))
+        PROFILER["block_threshold_ms"] = max(10, int(body.get("block_threshold_ms", PROFILER["block_threshold_ms"])))
+    except Exception as e:
+        return {"ok": False, "reason": f"Invalid profiler settings: {str(e)}"}
+
+    if not PROFILER["enabled"]:
+        PROFILER["enabled"] = True
+        PROFILER["generation"] += 1
+        PROFILER["watchdog_stop"] = threading.Event()
+        PROFILER["loop_thread"] = threading.get_ident()
+        _loop_heartbeat(asyncio.get_running_loop(), PROFILER["generation"])
+        threading.Thread(
+            target=_blocking_watchdog,
+            args=(PROFILER["generation"], PROFILER["watchdog_stop"]),
+            name="loop-watchdog",
+            daemon=True
+        ).start()
+
+    return {
+        "ok": True,
+        "sample_rate": PROFILER["sample_rate"],
+        "block_threshold_ms": PROFILER["block_threshold_ms"]
+    }
+
+
+@app.post("/admin/profile/stop")
+@json_endpoint
+def stop_profiler(request: Request):
+    """Turns profiling off; collected data stays available until reset."""
+    require_admin(request)
+    PROFILER["enabled"] = False
+    if PROFILER["watchdog_stop"] is not None:
+        PROFILER["watchdog_stop"].set()
+    return {"ok": True}
+
+
+@app.post("/admin/profile/reset")
+@json_endpoint
+def reset_profiler(request: Request):
+    require_admin(request)
+    PROFILER["stats"] = None
+    PROFILER["profiled"] = {}
+    BLOCKING_EVENTS.clear()
+    return {"ok": True}
+
+
+@app.get("/admin/profile")
+def download_profile(request: Request, format: str = "text", sort: str = "cumulative", limit: int = 50):
+    """
+    Aggregated request profile (event-loop thread only; see the section notes).
+    format=text → pstats report; format=pstats → binary file for pstats/snakeviz.
+    """
+    require_admin(request)
+    stats = PROFILER["stats"]
+    if stats is None:
+        return FastJSONResponse({"ok": False, "reason": "No profiled requests yet"})
+
+    if format == "pstats":
+        return Response(
+            marshal.dumps(stats.stats),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": "attachment; filename=fud-ai.pstats"}
+        )
+
+    out = io.StringIO()
+    stats.stream = out
+    try:
+        stats.sort_stats(sort)
+    except KeyError:
+        stats.sort_stats("cumulative")
+    stats.print_stats(limit)
+    return Response(out.getvalue(), media_type="text/plain")
+
+
+@app.get("/admin/profile/blocking")
+@json_endpoint
+def blocking_report(request: Request):
+    """Event-loop stalls seen by the watchdog, newest last."""
+    require_admin(request)
+    return {
+        "enabled": PROFILER["enabled"],
+        "block_threshold_ms": PROFILER["block_threshold_ms"],
+        "profiled_requests": PROFILER["profiled"],
+        "events": list(BLOCKING_EVENTS)
+    }
+
+
+# Set by the replay engine so recorded traffic never reaches OnDemand
+AGENT_STUB = {"active": False}
+
+
+def post_agent(url: str, json=None, headers=HEADERS):
+    """Single exit point for every upstream agent / follow-up call (traced)."""
+    return traced_agent_post(url, json, headers)
+
+
+def _post_agent_untraced(url: str, json=None, headers=HEADERS):
+    if AGENT_STUB["active"]:
+        return agent_stub_post(url, json)
+
+    compressed = compress_outbound(url, json, headers)
+    if compressed:
+        data, gz_headers = compressed
+        return requests.post(url, data=data, headers=gz_headers)
+
+    return requests.post(url, json=json, headers=headers)
+
+
 def detect_learning_intent(text: str) -> dict:
     if not isinstance(text, str):
         return {"activate": False}
@@ -159,28 +1240,28 @@ def detect_learning_intent(text: str) -> dict:
 # ===========================
 
 @app.post("/chat")
+@json_endpoint
 async def chat_connector(request: Request):
-    raw = await request.body()
-
-    try:
-        body = json.loads(raw)
-    except Exception:
-        body = raw.decode(errors="ignore")
-
-    if isinstance(body, str):
-        user_input = body.strip()
-        session_id = "anonymous"
-    elif isinstance(body, dict):
-        user_input = body.get("user_input", "")
-        session_id = body.get("session_id", "anonymous")
-    else:
+    chat = ChatRequest.from_body(await parse_body(request))
+    if chat is None:
         return {"ok": False}
 
+    user_input = chat.user_input
+    session_id = chat.session_id
+
     if not user_input:
         return {"ok": True, "status": "empty"}
 
     intent = detect_learning_intent(user_input)
 
+    # Exam starts outrank casual chat when agents are under load
+    if intent["activate"]:
+        retry_after = admit(session_id, QUESTION_URL, "exam")
+    else:
+        retry_after = admit(session_id, CHAT_API_URL, "chat")
+    if retry_after:
+        return shed_response(retry_after)
+
     if intent["activate"]:
         raw_concept = intent["topic"]
 
@@ -189,9 +1270,11 @@ async def chat_connector(request: Request):
         else:
             STATE["current_concept"] = normalize_concept(raw_concept)
 
-        STATE["phase"] = "idle"   # exam-ready state
+        set_phase("idle")   # exam-ready state
+        STATE["session_id"] = session_id
 
-        requests.post(
+        expect_webhook("question")
+        post_agent(
             QUESTION_URL,
             json={
                 "previous_topic": None,
@@ -215,7 +1298,7 @@ async def chat_connector(request: Request):
 
 
     # ---- Otherwise, just chat ----
-    r = requests.post(
+    r = post_agent(
         CHAT_API_URL,
         json={
             "session_id": session_id,
@@ -236,6 +1319,7 @@ async def chat_connector(request: Request):
 
 
 @app.get("/chat/result/{execution_id}")
+@json_endpoint
 def get_chat_result(execution_id: str):
     if execution_id in CHAT_RESPONSES:
         return {
@@ -255,14 +1339,19 @@ def get_chat_result(execution_id: str):
 # ===========================
 
 CHAT_RESPONSES = {}  # execution_id → response text
+CHAT_PARTIALS = {}   # execution_id → text received so far (incremental deliveries)
+CHAT_STREAMS = {}    # execution_id → asyncio.Queue of (chunk, done) for live streams
+
+CHAT_STREAM_IDLE_TIMEOUT = 60   # seconds without a delivery before a stream closes
 
 @app.post("/chat/webhook")
+@json_endpoint
 async def chat_webhook(request: Request):
-    raw = (await request.body()).decode()
+    raw = (await request.body()).decode(errors="ignore")
     print("RAW WEBHOOK BODY:", raw)
     sys.stdout.flush()
 
-    payload = safe_parse_json(raw)
+    payload = await parse_webhook(request)
 
     # -------- Extract chat text --------
     if isinstance(payload, dict):
@@ -270,70 +1359,156 @@ async def chat_webhook(request: Request):
             payload.get("text")
             or payload.get("outputs", {}).get("text")
         )
+        execution_id = payload.get("executionID") or payload.get("execution_id")
+        # Single deliveries are final; incremental ones send "done": false until the last
+        done = payload.get("done", True) is not False
     else:
         text = raw.strip()
+        execution_id = None
+        done = True
 
-    if not text:
+    if not execution_id:
         return "OK"
 
-    print("STORED CHAT RESPONSE:", text)
-    sys.stdout.flush()
+    if not isinstance(text, str):
+        text = ""
 
+    key = chat_delivery_key(execution_id, payload, done)
+    seen = webhook_seen(key)
+    if seen is not None:
+        return seen
+    webhook_remember(key, "OK")
 
-    return "OK"
+    queue = CHAT_STREAMS.get(execution_id)
+    if queue is not None:
+        queue.put_nowait((text, done))
 
+    if done:
+        CHAT_RESPONSES[execution_id] = CHAT_PARTIALS.pop(execution_id, "") + text
+        print("STORED CHAT RESPONSE:", CHAT_RESPONSES[execution_id])
+        sys.stdout.flush()
+    elif text:
+        CHAT_PARTIALS[execution_id] = CHAT_PARTIALS.get(execution_id, "") + text
 
-@app.post("/media/extract")
-async def media_knowledge_extract(request: Request):
+    return "OK"
+
+
+CHAT_CHUNK_SEQUENCE_FIELDS = ("seq", "sequence", "offset", "index")
+
+
+def chat_delivery_key(execution_id, payload: dict, done: bool):
     """
-    Media Knowledge API
-    Extracts readable text from media payloads.
-    Also performs learning-intent detection.
+    Final delivery: one per execution. Chunks: execution ID plus their
+    sequence/offset field; chunks without one can't be told apart from a
+    legitimate repeat ("ha", "ha") and are never de-duplicated.
     """
-    raw = await request.body()
+    if AGENT_STUB["active"]:
+        return None
 
-    # -------- HARD NORMALIZATION --------
-    try:
-        body = json.loads(raw)
-    except Exception:
-        body = raw.decode(errors="ignore")
+    if done:
+        return ("chat", f"{execution_id}:done")
 
-    extracted_text = ""
+    for field in CHAT_CHUNK_SEQUENCE_FIELDS:
+        if payload.get(field) is not None:
+            return ("chat", f"{execution_id}:{field}={payload[field]}")
 
-    # Case 1: raw string
-    if isinstance(body, str):
-        extracted_text = body.strip()
+    return None
 
-    # Case 2: structured media payload
-    elif isinstance(body, dict):
-        extracted_text = (
-            body.get("text")
-            or body.get("raw_text")
-            or body.get("content")
-            or body.get("transcript")
-            or ""
-        )
 
-        if isinstance(extracted_text, list):
-            extracted_text = "\n".join(
-                str(x) for x in extracted_text if isinstance(x, (str, int, float))
-            )
+def _sse(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
 
-        if not isinstance(extracted_text, str):
-            extracted_text = str(extracted_text)
 
-    else:
-        extracted_text = str(body)
+async def relay_chat_stream(execution_id: str):
+    """Yields SSE events for a chat execution as webhook deliveries arrive."""
+    yield _sse({"execution_id": execution_id}, "start")
+
+    # Already finished before the client subscribed
+    if execution_id in CHAT_RESPONSES:
+        yield _sse({"text": CHAT_RESPONSES.pop(execution_id)})
+        yield _sse({}, "done")
+        return
+
+    queue = CHAT_STREAMS.setdefault(execution_id, asyncio.Queue())
+
+    # Replay what arrived before the subscription
+    if CHAT_PARTIALS.get(execution_id):
+        yield _sse({"text": CHAT_PARTIALS[execution_id]})
+
+    try:
+        while True:
+            try:
+                chunk, done = await asyncio.wait_for(
+                    queue.get(), timeout=CHAT_STREAM_IDLE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                yield _sse({}, "timeout")
+                return
+
+            if chunk:
+                yield _sse({"text": chunk})
+
+            if done:
+                CHAT_RESPONSES.pop(execution_id, None)
+                yield _sse({}, "done")
+                return
+    finally:
+        CHAT_STREAMS.pop(execution_id, None)
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: Request):
+    """
+    Streaming variant of /chat.
+    Tutoring replies are relayed as Server-Sent Events; exam starts return JSON as usual.
+    """
+    result = await chat_connector.__wrapped__(request)
+
+    execution_id = result.get("execution_id") if isinstance(result, dict) else None
+    if not execution_id:
+        return result
+
+    return StreamingResponse(
+        relay_chat_stream(execution_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.get("/chat/stream/{execution_id}")
+async def chat_stream_resume(execution_id: str):
+    """Subscribes to an already-started chat execution as Server-Sent Events."""
+    return StreamingResponse(
+        relay_chat_stream(execution_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
 
-    extracted_text = extracted_text.strip()
+
+@app.post("/media/extract")
+@json_endpoint
+async def media_knowledge_extract(request: Request):
+    """
+    Media Knowledge API
+    Extracts readable text from media payloads.
+    Also performs learning-intent detection.
+    """
+    # -------- HARD NORMALIZATION --------
+    extracted_text = MediaRequest.from_body(await parse_body(request)).text
 
     # -------- INTENT GATE --------
     intent = detect_learning_intent(extracted_text)
 
     if intent["activate"] and STATE["phase"] == "idle":
+        retry_after = admit(STATE.get("session_id"), QUESTION_URL, "exam")
+        if retry_after:
+            return shed_response(retry_after)
+
         STATE["current_concept"] = normalize_concept(intent["topic"])
 
-        requests.post(
+        expect_webhook("question")
+        post_agent(
             QUESTION_URL,
             json={
                 "previous_topic": None,
@@ -358,12 +1533,14 @@ async def media_knowledge_extract(request: Request):
 
 
 @app.post("/generate/media/extract")
+@json_endpoint
 async def media_knowledge_extract_alias(request: Request):
     """Alias for media knowledge extraction."""
     return await media_knowledge_extract(request)
 
 
 @app.post("/generate/chat")
+@json_endpoint
 async def chat_connector_alias(request: Request):
     """Alias for chat connector."""
     return await chat_connector(request)
@@ -376,6 +1553,10 @@ def normalize_concept(concept: str) -> str:
 
     c = concept.lower()
 
+    # Already-canonical names (e.g. "subqueries") pass through unchanged
+    if c in CANONICAL_KEYWORDS:
+        return c
+
     if "join" in c:
         return "joins"
     if "transaction" in c or "savepoint" in c:
@@ -410,6 +1591,135 @@ CANONICAL_KEYWORDS = {
     "views": ["view", "materialized", "refresh"]
 }
 
+# ===========================
+# LOCAL QUESTION BANK
+# ===========================
+# Fallback + cache tier for agent-generated questions.
+# Filled from seed files and from agent outputs that pass the concept gate.
+
+QUESTION_BANK_SEED_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "question_bank_seed.json"
+)
+
+QUESTION_TYPES = ("base", "probe", "mcq", "text")
+DIFFICULTIES = ("easy", "medium", "hard")
+
+# concept → question type → difficulty → [entry, ...]  (append-only)
+QUESTION_BANK = {}
+
+# (concept, question type, normalized text) — de-duplicates inserts
+QUESTION_BANK_SEEN = set()
+
+# (session_id, concept, question type, difficulty) → next unserved index
+QUESTION_BANK_CURSORS = {}
+
+JOIN_FALLBACK_QUESTION = (
+    "Table A has ids 1 and 2. "
+    "Table B has id 2 only. "
+    "Using LEFT JOIN A to B on id, which rows appear?"
+)
+
+
+def bank_add(concept, qtype, question, options=None, difficulty=None) -> bool:
+    """Adds a question to the bank. Returns False for duplicates or bad input."""
+    if AGENT_STUB["active"]:
+        return False    # stub questions never reach the live bank
+
+    if concept not in CANONICAL_KEYWORDS or qtype not in QUESTION_TYPES:
+        return False
+
+    if not isinstance(question, str) or not question.strip():
+        return False
+
+    question = question.strip()
+    key = (concept, qtype, " ".join(question.lower().split()))
+    if key in QUESTION_BANK_SEEN:
+        return False
+
+    if difficulty not in DIFFICULTIES:
+        difficulty = "medium"
+
+    entry = {"question": question}
+    if isinstance(options, dict):
+        entry["options"] = dict(options)
+
+    QUESTION_BANK_SEEN.add(key)
+    (
+        QUESTION_BANK
+        .setdefault(concept, {})
+        .setdefault(qtype, {})
+        .setdefault(difficulty, [])
+        .append(entry)
+    )
+    return True
+
+
+def bank_pick(session_id, concept, qtype, difficulty=None):
+    """
+    Returns the next unserved entry for this session, or None.
+    Entries are append-only, so a per-session cursor guarantees no repeats.
+    """
+    by_difficulty = QUESTION_BANK.get(concept, {}).get(qtype)
+    if not by_difficulty:
+        return None
+
+    order = (difficulty,) if difficulty in DIFFICULTIES else DIFFICULTIES
+
+    for d in order:
+        entries = by_difficulty.get(d)
+        if not entries:
+            continue
+
+        cursor_key = (session_id or "anonymous", concept, qtype, d)
+        i = QUESTION_BANK_CURSORS.get(cursor_key, 0)
+        if i < len(entries):
+            QUESTION_BANK_CURSORS[cursor_key] = i + 1
+            return entries[i]
+
+    return None
+
+
+def load_question_bank_seed(path: str) -> int:
+    """Loads seed questions from a JSON list. Returns the number added."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            rows = json.load(f)
+    except Exception as e:
+        print("QUESTION BANK SEED NOT LOADED:", e)
+        return 0
+
+    if not isinstance(rows, list):
+        return 0
+
+    added = 0
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        added += bank_add(
+            normalize_concept(row.get("concept")),
+            row.get("type"),
+            row.get("question"),
+            options=row.get("options"),
+            difficulty=row.get("difficulty")
+        )
+    return added
+
+
+load_question_bank_seed(QUESTION_BANK_SEED_PATH)
+
+
+@app.get("/question_bank/stats")
+@json_endpoint
+def question_bank_stats():
+    """Counts bank entries per concept and question type."""
+    return {
+        concept: {
+            qtype: sum(len(v) for v in by_difficulty.values())
+            for qtype, by_difficulty in by_type.items()
+        }
+        for concept, by_type in QUESTION_BANK.items()
+    }
+
 # ===========================
 # EXAM FLOW
 # ===========================
@@ -442,14 +1752,26 @@ CANONICAL_KEYWORDS = {
 
 
 @app.post("/question")
+@json_endpoint
 async def question_webhook(request: Request):
     print("QUESTION WEBHOOK HIT")
     sys.stdout.flush()
 
-    payload = safe_parse_json((await request.body()).decode())
+    payload = await parse_webhook(request)
     if not isinstance(payload, dict):
         return "OK"
 
+    # Retried delivery → answer from the record, never replace the active question
+    key = await webhook_dedup_key("question", request, payload)
+    seen = webhook_seen(key)
+    if seen is not None:
+        return seen
+
+    if not webhook_is_current("question"):
+        return webhook_remember(key, "OK")
+
+    webhook_remember(key, "OK")
+
     question = payload.get("question", "")
     concept = STATE["current_concept"]
 
@@ -460,31 +1782,31 @@ async def question_webhook(request: Request):
     sig = CONCEPT_SIGNATURES[concept]
 
     # 🚪 CONCEPT GATE
+    rejected = False
     if not any(k in q for k in sig["required"]):
         print("REJECTED: missing required concept signal")
-        question = (
-            "Table A has ids 1 and 2. "
-            "Table B has id 2 only. "
-            "Using LEFT JOIN A to B on id, which rows appear?"
-        )
+        rejected = True
 
     if any(k in q for k in sig["forbidden"]):
         print("REJECTED: forbidden concept leakage")
-        question = (
-            "Table A has ids 1 and 2. "
-            "Table B has id 2 only. "
-            "Using LEFT JOIN A to B on id, which rows appear?"
-        )
+        rejected = True
+
+    if rejected:
+        banked = bank_pick(STATE.get("session_id"), concept, "base")
+        question = banked["question"] if banked else JOIN_FALLBACK_QUESTION
+    else:
+        bank_add(concept, "base", question, difficulty=payload.get("difficulty"))
 
     # ✅ Accept question
     STATE["current_question"] = question
-    STATE["phase"] = "waiting_base"
+    set_phase("waiting_base")
 
     return "OK"
 
 
 
 @app.get("/question")
+@json_endpoint
 def get_question():
     phase = STATE["phase"]
 
@@ -512,35 +1834,129 @@ def get_question():
     }
 
 
+# ===========================
+# ANSWER PRE-SCREEN
+# ===========================
+# Cheap local checks that settle clear-cut answers without an agent call.
+
+PRESCREEN_MIN_WORDS = 2          # base answers with fewer words (empty / one word) → nothing to judge
+
+PRESCREEN_PROBES = {
+    "too_short": "Can you expand on that? Walk through your reasoning step by step.",
+    "copy_of_question": "You restated the question. What is your actual answer, and why?"
+}
+
+PRESCREEN_FAILURE_POINTS = {
+    "too_short": "Answer too short to show reasoning.",
+    "copy_of_question": "Answer repeats the question without reasoning."
+}
+
+PRESCREEN_STATS = {
+    "screened": 0,
+    "short_circuited": 0,
+    "too_short": 0,
+    "copy_of_question": 0
+}
+
+
+def _words(text) -> list:
+    return re.findall(r"[a-z0-9_]+", text.lower()) if isinstance(text, str) else []
+
+
+def _prescreen_verdict(question, answer, phase="base"):
+    """
+    Only unambiguous cases: verbatim copies of the question, empty answers,
+    and one-word base answers. A one-word probe answer ("NULL") can be
+    right, so probes only settle when empty. Anything with content of its
+    own goes to the agent, even when it reuses the question's words.
+    """
+    words = _words(answer)
+    min_words = PRESCREEN_MIN_WORDS if phase == "base" else 1
+    if len(words) < min_words:
+        return "too_short"
+    if words == _words(question):
+        return "copy_of_question"
+    return None
+
+
+def prescreen_answer(concept, question, answer, phase="base") -> dict:
+    """
+    Scores an answer on keyword coverage and length.
+    phase is "base" or "probe".
+    verdict is set only for clear cases; None means "ask the agent".
+    """
+    words = _words(answer)
+    keywords = CANONICAL_KEYWORDS.get(concept, [])
+    hits = sum(1 for k in keywords if k in set(words))
+
+    verdict = _prescreen_verdict(question, answer, phase)
+
+    # Replay runs don't count towards live savings
+    if not AGENT_STUB["active"]:
+        PRESCREEN_STATS["screened"] += 1
+        if verdict:
+            PRESCREEN_STATS["short_circuited"] += 1
+            PRESCREEN_STATS[verdict] += 1
+
+    return {
+        "verdict": verdict,
+        "coverage": hits / len(keywords) if keywords else 0.0,
+        "words": len(words)
+    }
+
+
+@app.get("/prescreen/stats")
+@json_endpoint
+def prescreen_stats():
+    """Pre-screen counters and the share of agent calls saved."""
+    screened = PRESCREEN_STATS["screened"]
+    return {
+        **PRESCREEN_STATS,
+        "saved_ratio": PRESCREEN_STATS["short_circuited"] / screened if screened else 0.0
+    }
+
+
 @app.post("/answer")
+@json_endpoint
 async def submit_answer(request: Request):
-    raw = await request.body()
-
     # -------- HARD NORMALIZATION --------
-    try:
-        body = json.loads(raw)
-    except Exception:
-        body = raw.decode(errors="ignore")
-
-    if isinstance(body, str):
-        answer = body.strip()
-    elif isinstance(body, dict):
-        answer = body.get("answer", "")
-    else:
-        answer = ""
+    answer = AnswerRequest.from_body(await parse_body(request)).answer
 
     if not answer:
         return {"status": "empty answer ignored"}
 
+    # Pre-screen first: answers it settles locally need no agent token
+    screen = {"verdict": None}
+    if STATE["phase"] == "waiting_base":
+        screen = prescreen_answer(STATE["current_concept"], STATE["current_question"], answer)
+    elif STATE["phase"] == "waiting_probe":
+        screen = prescreen_answer(STATE["current_concept"], STATE["probe_question"], answer, "probe")
+
+    # Shed before any state changes so the client can simply retry
+    agent_url = {"waiting_base": PROBE_URL, "waiting_probe": STABILIZER_URL}.get(STATE["phase"])
+    if agent_url and not screen["verdict"]:
+        retry_after = admit(STATE.get("session_id"), agent_url, "exam")
+        if retry_after:
+            return shed_response(retry_after)
+
     # ============================
     # BASE ANSWER → GENERATE PROBE
     # ============================
     if STATE["phase"] == "waiting_base":
         STATE["base_answer"] = answer
-        STATE["phase"] = "generating_probe"
+
+        # Clear-cut answers get a canned probe instead of a probe-agent call
+        if screen["verdict"]:
+            STATE["probe_question"] = PRESCREEN_PROBES[screen["verdict"]].format(
+                concept=STATE["current_concept"]
+            )
+            set_phase("waiting_probe")
+            return {"status": "Base answer received"}
+
+        set_phase("generating_probe")
 
         # 🔴 FIX 1: Correct payload for Probe Agent
-        r = requests.post(
+        r = post_agent(
             PROBE_URL,
             json={
                 "concept": STATE["current_concept"],
@@ -561,13 +1977,16 @@ async def submit_answer(request: Request):
 
         if isinstance(probe_q, str) and probe_q.strip():
             STATE["probe_question"] = probe_q.strip()
+            bank_add(STATE["current_concept"], "probe", probe_q)
         else:
             # HARD GUARANTEE — NEVER STALL THE EXAM
+            banked = bank_pick(STATE.get("session_id"), STATE["current_concept"], "probe")
             STATE["probe_question"] = (
-                "Explain your reasoning step by step."
+                banked["question"] if banked
+                else "Explain your reasoning step by step."
             )
 
-        STATE["phase"] = "waiting_probe"
+        set_phase("waiting_probe")
         return {"status": "Base answer received"}
 
     # ============================
@@ -575,9 +1994,21 @@ async def submit_answer(request: Request):
     # ============================
     if STATE["phase"] == "waiting_probe":
         STATE["probe_answer"] = answer
-        STATE["phase"] = "analyzing"
-
-        requests.post(
+        set_phase("analyzing")
+
+        # Clear-cut answers get a local verdict instead of a stabilizer call
+        if screen["verdict"]:
+            apply_stability_result({
+                "confidence": 0.2,
+                "gap_score": 0.8,
+                "understanding": "insufficient",
+                "failure_point": PRESCREEN_FAILURE_POINTS[screen["verdict"]],
+                "source": "prescreen"
+            })
+            return {"status": "Probe answer received"}
+
+        expect_webhook("stabilizer")
+        post_agent(
             STABILIZER_URL,
             json={
                 "base_question": STATE["current_question"],
@@ -598,10 +2029,17 @@ async def submit_answer(request: Request):
 # ===========================
 
 @app.post("/probe")
+@json_endpoint
 async def probe_webhook(request: Request):
+    payload = await parse_webhook(request)
+
+    key = await webhook_dedup_key("probe", request, payload)
+    seen = webhook_seen(key)
+    if seen is not None:
+        return seen
+
     STATE["probe_count"] += 1
-    raw = (await request.body()).decode()
-    payload = safe_parse_json(raw)
+    webhook_remember(key, "OK")
 
     print("PROBE PAYLOAD (telemetry only):", payload)
     sys.stdout.flush()
@@ -612,6 +2050,7 @@ async def probe_webhook(request: Request):
 
 
 @app.get("/probe")
+@json_endpoint
 def get_probe(session_id: str = "anonymous"):
     probes = [
         x for x in SESSION_STORE.get(session_id, [])
@@ -625,6 +2064,7 @@ def get_probe(session_id: str = "anonymous"):
 
 
 @app.get("/session/probes/{session_id}")
+@json_endpoint
 def get_probes(session_id: str):
     return [
         x for x in SESSION_STORE.get(session_id, [])
@@ -636,9 +2076,9 @@ def get_probes(session_id: str):
 # ===========================
 
 @app.post("/stabilizer")
+@json_endpoint
 async def stabilizer_webhook(request: Request):
-    raw = (await request.body()).decode()
-    payload = safe_parse_json(raw)
+    payload = await parse_webhook(request)
 
     print("STABILIZER PAYLOAD:", payload)
     sys.stdout.flush()
@@ -646,8 +2086,60 @@ async def stabilizer_webhook(request: Request):
     if not isinstance(payload, dict):
         return "OK"
 
+    key = await webhook_dedup_key("stabilizer", request, payload)
+    seen = webhook_seen(key)
+    if seen is not None:
+        return seen
+
+    # Cohort verdicts (by execution ID or cohort_id tag) never touch the live exam
+    if cohort_route_verdict(payload):
+        return webhook_remember(key, "OK")
+
+    # Only the verdict for the current analysis may advance the exam
+    if not webhook_is_current("stabilizer"):
+        return webhook_remember(key, "OK")
+
+    # Remember before processing: follow-up generation can take a while
+    webhook_remember(key, "OK")
+    return apply_stability_result(payload)
+
+
+def banked_followup(session_id, concept, mode) -> dict:
+    """Local follow-up for when generation is unavailable (same tiers as /generate/*)."""
+    banked = bank_pick(session_id, concept, mode)
+    if banked:
+        return {"question_type": mode, **banked}
+
+    return {
+        "question_type": "text",
+        "question": "Explain your reasoning step by step."
+    }
+
+
+def stability_scores(payload: dict):
+    """
+    (confidence, gap_score) from a verdict payload, with the usual defaults
+    for missing values. Raises ValueError for unparseable or non-finite ones
+    ("NaN" parses as a float).
+    """
     confidence = float(payload.get("confidence", 0.5))
     gap = float(payload.get("gap_score", 1.0 - confidence))
+    if not (math.isfinite(confidence) and math.isfinite(gap)):
+        raise ValueError("non-finite stability score")
+    return confidence, gap
+
+
+def apply_stability_result(payload: dict):
+    """Stores a stability verdict and advances the exam (re-probe or follow-up)."""
+    try:
+        confidence, gap = stability_scores(payload)
+        scored = True
+    except (TypeError, ValueError) as e:
+        # Keep the exam moving on neutral scores; keep them out of analytics
+        print("REJECTED STABILITY SCORES:", e)
+        sys.stdout.flush()
+        confidence, gap = 0.5, 0.5
+        scored = False
 
     # Store stability result for UI
     STATE["stability_result"] = {
@@ -657,21 +2149,32 @@ async def stabilizer_webhook(request: Request):
         "failure_point": payload.get("failure_point")
     }
 
+    # Keep every stabilizer verdict for cross-session analytics; local
+    # pre-screen verdicts are synthetic scores, not measurements
+    if scored and payload.get("source") != "prescreen":
+        record_verdict(
+            STATE["current_concept"],
+            confidence,
+            gap,
+            payload.get("understanding"),
+            payload.get("failure_point"),
+            payload.get("session_id") or STATE.get("session_id")
+        )
+
     if confidence < 0.7 and STATE.get("probe_count", 0) < 2:
         STATE["probe_question"] = "Explain this again with a simple analogy."
-        STATE["phase"] = "waiting_probe"
+        set_phase("waiting_probe")
         return "OK"
 
-
-
-   
-    turns = len(SESSION_STORE.get("anonymous", []))
-    mode = "mcq" if gap >= 0.4 or turns < 2 else "text"
+    # Route through the shared heuristic engine (same rules as /heuristic/decide)
+    session_id = payload.get("session_id") or STATE.get("session_id") or "anonymous"
+    turns = len(SESSION_STORE.get(session_id, []))
+    mode, _ = decide_mode(gap, confidence, turns)
     STATE["followup_type"] = mode
 
     try:
         if mode == "mcq":
-            r = requests.post(
+            r = post_agent(
                 "http://127.0.0.1:8000/generate/mcq",
                 json={
                     "concept": STATE["current_concept"],
@@ -681,12 +2184,11 @@ async def stabilizer_webhook(request: Request):
                     "confidence_score": confidence
                 }
             )
-            STATE["followup_question"] = r.json()
 
 
 
         else:
-            r = requests.post(
+            r = post_agent(
                 "http://127.0.0.1:8000/generate/text",
                 json={
                     "concept": STATE["current_concept"],
@@ -694,159 +2196,640 @@ async def stabilizer_webhook(request: Request):
                     "base_answer": STATE["probe_answer"]
                 }
             )
+
+        # Shed by admission control: keep the exam step alive with a banked follow-up
+        if r.status_code == 429:
+            STATE["followup_question"] = banked_followup(session_id, STATE["current_concept"], mode)
+        else:
             STATE["followup_question"] = r.json()
 
-        STATE["phase"] = "followup"
+        set_phase("followup")
 
     except Exception as e:
         print("FOLLOWUP GENERATION ERROR:", e)
-        STATE["phase"] = "error"
+        set_phase("error")
 
     return "OK"
 
 
 
 # ===========================
-# HEURISTIC DECISION TOOL
+# STABILITY ANALYTICS (COLUMNAR)
 # ===========================
+# Append-only verdict log. Numeric fields live in NumPy arrays; text fields
+# are dictionary-encoded into integer codes (code 0 = missing).
 
-@app.post("/heuristic/decide")
-async def decide_question_mode(request: Request):
-    """Determines whether to show an MCQ or a Text probe based on user performance scores."""
-    body = await request.json()
+VERDICT_STORE_INITIAL_CAPACITY = 4096
+VERDICT_TEXT_MAX_LEN = 120
+VERDICT_PERCENTILE_RESOLUTION = 1000
 
-    try:
-        gap_score = float(body.get("gap_score", 0.0))
-        confidence_score = float(body.get("confidence_score", 0.0))
-        turns_so_far = int(body.get("turns_so_far", 0))
-    except Exception as e:
-        return {
-            "mode": "mcq",
-            "reason": f"Invalid heuristic inputs: {str(e)}"
-        }
+VERDICT_NUMERIC_COLUMNS = {
+    "confidence": np.float32,
+    "gap_score": np.float32,
+    "recorded_at": np.float64
+}
+VERDICT_CODED_COLUMNS = {
+    "concept": np.int16,          # normalize_concept() yields a handful of names
+    "understanding": np.int32,
+    "failure_point": np.int32,
+    "session_id": np.int32
+}
 
-    if turns_so_far < 2:
-        return {"mode": "mcq", "reason": "Early session stabilization."}
+VERDICT_STORE = {"size": 0}
+for _col, _dtype in {**VERDICT_NUMERIC_COLUMNS, **VERDICT_CODED_COLUMNS}.items():
+    VERDICT_STORE[_col] = np.empty(VERDICT_STORE_INITIAL_CAPACITY, dtype=_dtype)
 
-    if gap_score >= 0.6 and confidence_score <= 0.4:
-        return {"mode": "mcq", "reason": "Large gap with low confidence."}
+# column → (code → value list, value → code dict)
+VERDICT_DICTIONARIES = {col: ([None], {}) for col in VERDICT_CODED_COLUMNS}
 
-    if gap_score >= 0.4 and confidence_score < 0.6:
-        return {"mode": "mcq", "reason": "Partial understanding detected."}
 
-    if gap_score < 0.4 and confidence_score >= 0.6:
-        return {"mode": "text", "reason": "Low gap with high confidence."}
+def _encode_verdict_value(column: str, value) -> int:
+    """Dictionary-encodes a text value; None/empty map to code 0."""
+    if not isinstance(value, str) or not value.strip():
+        return 0
 
-    return {"mode": "text", "reason": "Defaulting to open-ended reasoning."}
+    value = " ".join(value.split())[:VERDICT_TEXT_MAX_LEN]
+    values, codes = VERDICT_DICTIONARIES[column]
 
-@app.post("/generate/mcq")
-async def generate_mcq_probe(request: Request):
-    raw = await request.body()
+    code = codes.get(value)
+    if code is None:
+        code = len(values)
+        values.append(value)
+        codes[value] = code
+    return code
 
-    try:
-        body = json.loads(raw)
-    except Exception:
-        body = {}
 
-    response = requests.post(
-        MCQ_AGENT_URL,
-        json=body,
-        headers=HEADERS
-    )
+def _grow_verdict_store() -> None:
+    capacity = len(VERDICT_STORE["confidence"]) * 2
+    for col in (*VERDICT_NUMERIC_COLUMNS, *VERDICT_CODED_COLUMNS):
+        grown = np.empty(capacity, dtype=VERDICT_STORE[col].dtype)
+        grown[:VERDICT_STORE["size"]] = VERDICT_STORE[col][:VERDICT_STORE["size"]]
+        VERDICT_STORE[col] = grown
 
-    parsed = safe_parse_json(response.text)
 
-    # 🚨 ABSOLUTE GUARANTEE FOR FRONTEND
-    if not isinstance(parsed, dict) or "question" not in parsed:
-        return {
-            "question_type": "mcq",
-            "question": "Which statement is correct?",
-            "options": {
-                "A": "LEFT JOIN keeps unmatched left rows",
-                "B": "INNER JOIN removes unmatched rows",
-                "C": "FULL JOIN keeps all rows",
-                "D": "RIGHT JOIN keeps unmatched right rows"
-            }
-        }
+def record_verdict(concept, confidence, gap_score, understanding=None,
+                   failure_point=None, session_id=None, recorded_at=None) -> bool:
+    """
+    Appends one stability verdict to the columnar store. Non-finite scores
+    and replayed (stubbed) verdicts are skipped.
+    """
+    if AGENT_STUB["active"]:
+        return False
+
+    if not (math.isfinite(confidence) and math.isfinite(gap_score)):
+        return False
+
+    i = VERDICT_STORE["size"]
+    if i == len(VERDICT_STORE["confidence"]):
+        _grow_verdict_store()
+
+    VERDICT_STORE["confidence"][i] = confidence
+    VERDICT_STORE["gap_score"][i] = gap_score
+    VERDICT_STORE["recorded_at"][i] = time.time() if recorded_at is None else recorded_at
+    VERDICT_STORE["concept"][i] = _encode_verdict_value("concept", concept)
+    VERDICT_STORE["understanding"][i] = _encode_verdict_value("understanding", understanding)
+    VERDICT_STORE["failure_point"][i] = _encode_verdict_value("failure_point", failure_point)
+    VERDICT_STORE["session_id"][i] = _encode_verdict_value("session_id", session_id)
+    VERDICT_STORE["size"] = i + 1
+    return True
+
+
+def verdict_columns() -> dict:
+    """Views of the filled part of every column (no copies)."""
+    n = VERDICT_STORE["size"]
+    return {
+        col: VERDICT_STORE[col][:n]
+        for col in (*VERDICT_NUMERIC_COLUMNS, *VERDICT_CODED_COLUMNS)
+    }
 
-    options = parsed.get("options")
 
-    if not isinstance(options, dict) or len(options) != 4:
-        options = {
-            "A": "Option A",
-            "B": "Option B",
-            "C": "Option C",
-            "D": "Option D"
+def _grouped_percentiles(codes: np.ndarray, values: np.ndarray, n_groups: int,
+                         quantiles=(10, 50, 90)) -> np.ndarray:
+    """
+    Nearest-rank percentiles of [0, 1] scores per group, at
+    1/VERDICT_PERCENTILE_RESOLUTION precision. One bincount builds every
+    group's histogram, so no per-group sort or partition is needed.
+    Returns an (n_groups, len(quantiles)) array.
+    """
+    res = VERDICT_PERCENTILE_RESOLUTION
+    bins = (np.clip(values, 0.0, 1.0) * res + 0.5).astype(np.intp)
+    hist = np.bincount(
+        codes.astype(np.intp) * (res + 1) + bins,
+        minlength=n_groups * (res + 1)
+    ).reshape(n_groups, res + 1)
+
+    cdf = np.cumsum(hist, axis=1)
+    out = np.empty((n_groups, len(quantiles)))
+    for j, q in enumerate(quantiles):
+        rank = np.maximum(np.ceil(cdf[:, -1] * (q / 100.0)), 1)
+        out[:, j] = np.argmax(cdf >= rank[:, None], axis=1) / res
+    return out
+
+
+def stability_analytics(concept=None, since=None, bucket_seconds=86400, top_failures=10) -> dict:
+    """Per-concept percentiles, failure-point histogram and trend buckets."""
+    cols = verdict_columns()
+
+    mask = None
+    if concept:
+        mask = cols["concept"] == VERDICT_DICTIONARIES["concept"][1].get(concept, -1)
+    if since is not None:
+        since_mask = cols["recorded_at"] >= since
+        mask = since_mask if mask is None else mask & since_mask
+
+    if mask is not None:
+        cols = {col: values[mask] for col, values in cols.items()}
+
+    conf = cols["confidence"]
+    gap = cols["gap_score"]
+    concept_codes = cols["concept"]
+    failure_codes = cols["failure_point"]
+    recorded_at = cols["recorded_at"]
+
+    concept_names = VERDICT_DICTIONARIES["concept"][0]
+    failure_names = VERDICT_DICTIONARIES["failure_point"][0]
+
+    # -------- Per-concept percentiles --------
+    per_concept = {}
+    counts = np.bincount(concept_codes, minlength=len(concept_names))
+    conf_pct = _grouped_percentiles(concept_codes, conf, len(counts))
+    gap_pct = _grouped_percentiles(concept_codes, gap, len(counts))
+    for code in np.flatnonzero(counts):
+        per_concept[concept_names[code] or "unknown"] = {
+            "count": int(counts[code]),
+            "confidence": dict(zip(("p10", "p50", "p90"), conf_pct[code].tolist())),
+            "gap_score": dict(zip(("p10", "p50", "p90"), gap_pct[code].tolist()))
         }
 
+    # -------- Failure-point histogram --------
+    failure_counts = np.bincount(failure_codes, minlength=len(failure_names))
+    failure_counts[0] = 0   # missing failure points are not a failure mode
+    top = np.argsort(failure_counts)[::-1][:top_failures]
+    failures = [
+        {"failure_point": failure_names[code], "count": int(failure_counts[code])}
+        for code in top if failure_counts[code]
+    ]
+
+    # -------- Cohort trend --------
+    trend = []
+    if len(recorded_at):
+        start = np.floor(recorded_at.min() / bucket_seconds) * bucket_seconds
+        buckets = ((recorded_at - start) * (1.0 / bucket_seconds)).astype(np.intp)
+        counts = np.bincount(buckets)
+        conf_sum = np.bincount(buckets, weights=conf)
+        gap_sum = np.bincount(buckets, weights=gap)
+        for b in np.flatnonzero(counts):
+            trend.append({
+                "bucket_start": float(start + b * bucket_seconds),
+                "count": int(counts[b]),
+                "mean_confidence": float(conf_sum[b] / counts[b]),
+                "mean_gap_score": float(gap_sum[b] / counts[b])
+            })
+
     return {
-        "question_type": "mcq",
-        "question": parsed.get("question"),
-        "options": options
+        "verdicts": int(len(conf)),
+        "per_concept": per_concept,
+        "failure_points": failures,
+        "trend": trend
     }
 
 
+@app.get("/analytics/stability")
+@json_endpoint
+def get_stability_analytics(concept: str = None, since: float = None, bucket_seconds: int = 86400):
+    """Aggregates every recorded stability verdict."""
+    if bucket_seconds <= 0:
+        raise HTTPException(400, "bucket_seconds must be positive")
 
-@app.post("/generate/text")
-async def generate_text_probe(request: Request):
-    """Interacts with the Text agent to create an open-ended probe question."""
-    raw = await request.body()
+    return stability_analytics(
+        concept=normalize_concept(concept) if concept else None,
+        since=since,
+        bucket_seconds=bucket_seconds
+    )
 
-    try:
-        body = json.loads(raw)
-    except Exception:
-        body = raw.decode()
 
-    # HARD NORMALIZATION
-    if isinstance(body, str):
-        body = {
-            "concept": None,
-            "base_question": body,
-            "base_answer": None,
-            "gap_score": 0.5,
-            "confidence_score": 0.5
-        }
+# ===========================
+# HEURISTIC DECISION TOOL
+# ===========================
 
-    if not isinstance(body, dict):
-        raise HTTPException(400, "Invalid text probe input payload")
+# Ordered rule cascade. The index of each entry is its rule id; the decision
+# table below stores rule ids so scalar and batch paths share one source.
+HEURISTIC_RULES = (
+    ("mcq", "Early session stabilization."),
+    ("mcq", "Large gap with low confidence."),
+    ("mcq", "Partial understanding detected."),
+    ("text", "Low gap with high confidence."),
+    ("text", "Defaulting to open-ended reasoning."),
+)
 
-    response = requests.post(
-        TEXT_AGENT_URL,
-        json=body,
-        headers=HEADERS
-    )
+HEURISTIC_MODES = np.array([mode for mode, _ in HEURISTIC_RULES])
+HEURISTIC_REASONS = np.array([reason for _, reason in HEURISTIC_RULES])
 
-    raw_output = response.text
-    print("RAW TEXT AGENT OUTPUT:\n", raw_output)
-    sys.stdout.flush()
 
-    parsed = safe_parse_json(raw_output)
+def _heuristic_cascade(gap_score: float, confidence_score: float, turns_so_far: int) -> int:
+    """Reference cascade; only used to compile the decision table."""
+    if turns_so_far < 2:
+        return 0
+    if gap_score >= 0.6 and confidence_score <= 0.4:
+        return 1
+    if gap_score >= 0.4 and confidence_score < 0.6:
+        return 2
+    if gap_score < 0.4 and confidence_score >= 0.6:
+        return 3
+    return 4
 
-    # HARD FALLBACK
-    if not isinstance(parsed, dict):
-        return {
-            "question_type": "text",
-            "question": raw_output.strip()
-        }
 
-    # NORMALIZATION
-    question = (
-        parsed.get("question")
-        or parsed.get("probe")
-        or parsed.get("prompt")
-        or parsed.get("text")
-    )
+def _compile_decision_table() -> np.ndarray:
+    """
+    Precomputes rule ids for every (turns, gap, confidence) cell.
+    Cells follow the cascade thresholds:
+      turns: <2 | >=2
+      gap:   <0.4 | [0.4, 0.6) | >=0.6
+      conf:  <=0.4 | (0.4, 0.6) | >=0.6
+    """
+    table = np.empty((2, 3, 3), dtype=np.int8)
+    for t_bin, turns in enumerate((0, 2)):
+        for g_bin, gap in enumerate((0.0, 0.5, 1.0)):
+            for c_bin, conf in enumerate((0.0, 0.5, 1.0)):
+                table[t_bin, g_bin, c_bin] = _heuristic_cascade(gap, conf, turns)
+    return table
 
-    if not isinstance(question, str):
-        return {
+
+DECISION_TABLE = _compile_decision_table()
+_DECISION_TABLE_PY = DECISION_TABLE.tolist()   # fast scalar lookups
+
+
+def decide_mode(gap_score: float, confidence_score: float, turns_so_far: int):
+    """
+    Single MCQ-vs-text decision used by every code path.
+    Returns (mode, reason).
+    """
+    t_bin = int(turns_so_far >= 2)
+
+    # NaN fails every cascade comparison (→ default rule); the bins would call it "low"
+    if gap_score != gap_score or confidence_score != confidence_score:
+        return HEURISTIC_RULES[4 if t_bin else 0]
+
+    g_bin = int(gap_score >= 0.4) + int(gap_score >= 0.6)
+    c_bin = int(confidence_score > 0.4) + int(confidence_score >= 0.6)
+
+    rule = _DECISION_TABLE_PY[t_bin][g_bin][c_bin]
+    return HEURISTIC_RULES[rule]
+
+
+def decide_modes_batch(gap_scores, confidence_scores, turns_so_far) -> np.ndarray:
+    """
+    Vectorized decide_mode over many rows.
+    Returns an int8 array of rule ids; map through HEURISTIC_MODES /
+    HEURISTIC_REASONS (or HEURISTIC_RULES) to get labels.
+    """
+    gap = np.asarray(gap_scores, dtype=np.float64)
+    conf = np.asarray(confidence_scores, dtype=np.float64)
+    turns = np.asarray(turns_so_far)
+
+    t_bin = (turns >= 2).astype(np.intp)
+    g_bin = (gap >= 0.4).astype(np.intp) + (gap >= 0.6)
+    c_bin = (conf > 0.4).astype(np.intp) + (conf >= 0.6)
+
+    rules = DECISION_TABLE[t_bin, g_bin, c_bin]
+    nan = np.isnan(gap) | np.isnan(conf)
+    if nan.any():
+        rules = np.where(nan & (turns >= 2), np.int8(4), rules)
+    return rules
+
+
+@app.post("/heuristic/decide")
+@json_endpoint
+async def decide_question_mode(request: Request):
+    """Determines whether to show an MCQ or a Text probe based on user performance scores."""
+    try:
+        inputs = HeuristicRequest.from_body(await parse_body(request))
+    except Exception as e:
+        return {
+            "mode": "mcq",
+            "reason": f"Invalid heuristic inputs: {str(e)}"
+        }
+
+    mode, reason = decide_mode(inputs.gap_score, inputs.confidence_score, inputs.turns_so_far)
+    return {"mode": mode, "reason": reason}
+
+
+@app.post("/heuristic/decide/batch")
+@json_endpoint
+async def decide_question_mode_batch(request: Request):
+    """
+    Scores many rows at once.
+    Input: {"rows": [{gap_score, confidence_score, turns_so_far}, ...]}
+    or rows as [gap_score, confidence_score, turns_so_far] lists.
+    """
+    body = await parse_body(request)
+    rows = body.get("rows") if isinstance(body, dict) else body
+
+    if not isinstance(rows, list):
+        return {"ok": False, "reason": "Missing rows"}
+
+    gap, conf, turns = [], [], []
+    try:
+        for r in rows:
+            if isinstance(r, dict):
+                r = (r.get("gap_score", 0.0), r.get("confidence_score", 0.0), r.get("turns_so_far", 0))
+            row = HeuristicRequest.from_row(r[0], r[1], r[2])
+            gap.append(row.gap_score)
+            conf.append(row.confidence_score)
+            turns.append(row.turns_so_far)
+    except Exception as e:
+        return {"ok": False, "reason": f"Invalid heuristic inputs: {str(e)}"}
+
+    rule_ids = decide_modes_batch(gap, conf, turns)
+
+    return {
+        "ok": True,
+        "count": len(rows),
+        "modes": HEURISTIC_MODES[rule_ids].tolist(),
+        "reasons": HEURISTIC_REASONS[rule_ids].tolist()
+    }
+
+# ===========================
+# FOLLOW-UP RESPONSE CACHE
+# ===========================
+# LRU + TTL cache for /generate/mcq and /generate/text.
+# Every cohort sees the same question pool, so most follow-ups repeat.
+
+FOLLOWUP_CACHE_MAX_ENTRIES = 2048
+FOLLOWUP_CACHE_TTL = 3600               # seconds, successful responses
+FOLLOWUP_CACHE_NEGATIVE_TTL = 60        # seconds, agent failures
+FOLLOWUP_CACHE_MAX_ENTRY_BYTES = 16384
+
+FOLLOWUP_CACHE = OrderedDict()          # key → (expires_at, response or None)
+FOLLOWUP_CACHE_MISS = object()
+
+FOLLOWUP_CACHE_STATS = {
+    "hits": 0,
+    "negative_hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "evictions": 0,
+    "oversize": 0
+}
+
+
+def answer_key(answer) -> str:
+    """
+    Hash of the answer lowercased with whitespace collapsed. Every token and
+    its order count: "id 1 is kept" and "id 2 is kept" are different answers.
+    """
+    text = " ".join(answer.lower().split()) if isinstance(answer, str) else ""
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def followup_cache_key(kind: str, body):
+    """(kind, concept, base question, answer key, gap bin, confidence bin)."""
+    if not isinstance(body, dict):
+        return None
+
+    try:
+        gap = float(body.get("gap_score", -1.0))
+        conf = float(body.get("confidence_score", -1.0))
+    except Exception:
+        return None
+
+    base_question = body.get("base_question")
+    return (
+        kind,
+        normalize_concept(body.get("concept")),
+        " ".join(base_question.lower().split()) if isinstance(base_question, str) else None,
+        answer_key(body.get("base_answer")),
+        int(gap >= 0.4) + int(gap >= 0.6) if gap >= 0 else -1,
+        int(conf > 0.4) + int(conf >= 0.6) if conf >= 0 else -1
+    )
+
+
+def followup_cache_get(key):
+    """Returns the cached response, None for a cached failure, or FOLLOWUP_CACHE_MISS."""
+    if key is None or AGENT_STUB["active"]:
+        return FOLLOWUP_CACHE_MISS      # replay neither reads nor fills the live cache
+
+    entry = FOLLOWUP_CACHE.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+            del FOLLOWUP_CACHE[key]
+        FOLLOWUP_CACHE_STATS["misses"] += 1
+        return FOLLOWUP_CACHE_MISS
+
+    FOLLOWUP_CACHE.move_to_end(key)
+    if entry[1] is None:
+        FOLLOWUP_CACHE_STATS["negative_hits"] += 1
+    else:
+        FOLLOWUP_CACHE_STATS["hits"] += 1
+    return entry[1]
+
+
+def followup_cache_put(key, response) -> None:
+    """Caches a response; pass None to negatively cache an agent failure."""
+    if key is None or AGENT_STUB["active"]:
+        return
+
+    if response is None:
+        ttl = FOLLOWUP_CACHE_NEGATIVE_TTL
+    else:
+        ttl = FOLLOWUP_CACHE_TTL
+        if len(json_dumps_bytes(response)) > FOLLOWUP_CACHE_MAX_ENTRY_BYTES:
+            FOLLOWUP_CACHE_STATS["oversize"] += 1
+            return
+
+    FOLLOWUP_CACHE[key] = (time.monotonic() + ttl, response)
+    FOLLOWUP_CACHE.move_to_end(key)
+    FOLLOWUP_CACHE_STATS["stores"] += 1
+
+    while len(FOLLOWUP_CACHE) > FOLLOWUP_CACHE_MAX_ENTRIES:
+        FOLLOWUP_CACHE.popitem(last=False)
+        FOLLOWUP_CACHE_STATS["evictions"] += 1
+
+
+def followup_lookup(kind: str, followup, agent_url: str):
+    """
+    Cache lookup, admission and agent call shared by the /generate endpoints.
+    Returns (cache_key, served, raw_output): served is a ready response
+    (cache hit or 429) to return as-is. After a recent agent failure the
+    raw output is "" and the key is dropped, so the fallbacks don't
+    re-cache the failure and push its expiry forward on every hit.
+    """
+    cache_key = followup_cache_key(kind, followup.payload)
+    cached = followup_cache_get(cache_key)
+
+    if cached is None:
+        return None, None, ""
+    if cached is not FOLLOWUP_CACHE_MISS:
+        return cache_key, cached, None
+
+    retry_after = admit(followup.session_id or STATE.get("session_id"), agent_url, "exam")
+    if retry_after:
+        return cache_key, shed_response(retry_after), None
+
+    response = post_agent(
+        agent_url,
+        json=followup.payload,
+        headers=HEADERS
+    )
+    return cache_key, None, response.text
+
+
+@app.get("/generate/cache/stats")
+@json_endpoint
+def followup_cache_stats():
+    """Follow-up cache counters and hit rate."""
+    lookups = (
+        FOLLOWUP_CACHE_STATS["hits"]
+        + FOLLOWUP_CACHE_STATS["negative_hits"]
+        + FOLLOWUP_CACHE_STATS["misses"]
+    )
+    served = FOLLOWUP_CACHE_STATS["hits"] + FOLLOWUP_CACHE_STATS["negative_hits"]
+    return {
+        **FOLLOWUP_CACHE_STATS,
+        "entries": len(FOLLOWUP_CACHE),
+        "hit_rate": served / lookups if lookups else 0.0
+    }
+
+
+@app.post("/generate/mcq")
+@json_endpoint
+async def generate_mcq_probe(request: Request):
+    followup = FollowupRequest.from_body(await parse_body(request)) or FollowupRequest({}, "unknown")
+
+    cache_key, served, raw_output = followup_lookup("mcq", followup, MCQ_AGENT_URL)
+    if served is not None:
+        return served
+
+    parsed = safe_parse_json(raw_output)
+
+    concept = followup.concept
+    session_id = followup.session_id or STATE.get("session_id")
+
+    # 🚨 ABSOLUTE GUARANTEE FOR FRONTEND
+    if not isinstance(parsed, dict) or "question" not in parsed:
+        followup_cache_put(cache_key, None)
+
+        banked = bank_pick(session_id, concept, "mcq")
+        if banked:
+            return {"question_type": "mcq", **banked}
+
+        return {
+            "question_type": "mcq",
+            "question": "Which statement is correct?",
+            "options": {
+                "A": "LEFT JOIN keeps unmatched left rows",
+                "B": "INNER JOIN removes unmatched rows",
+                "C": "FULL JOIN keeps all rows",
+                "D": "RIGHT JOIN keeps unmatched right rows"
+            }
+        }
+
+    options = parsed.get("options")
+
+    if not isinstance(options, dict) or len(options) != 4:
+        followup_cache_put(cache_key, None)
+
+        # Prefer a real banked MCQ over placeholder options
+        banked = bank_pick(session_id, concept, "mcq")
+        if banked:
+            return {"question_type": "mcq", **banked}
+
+        options = {
+            "A": "Option A",
+            "B": "Option B",
+            "C": "Option C",
+            "D": "Option D"
+        }
+    else:
+        bank_add(concept, "mcq", parsed.get("question"), options=options,
+                 difficulty=parsed.get("difficulty"))
+        followup_cache_put(cache_key, {
+            "question_type": "mcq",
+            "question": parsed.get("question"),
+            "options": options
+        })
+
+    return {
+        "question_type": "mcq",
+        "question": parsed.get("question"),
+        "options": options
+    }
+
+
+
+@app.post("/generate/text")
+@json_endpoint
+async def generate_text_probe(request: Request):
+    """Interacts with the Text agent to create an open-ended probe question."""
+    # HARD NORMALIZATION
+    followup = FollowupRequest.from_body(
+        await parse_body(request),
+        default={
+            "concept": None,
+            "base_question": None,
+            "base_answer": None,
+            "gap_score": 0.5,
+            "confidence_score": 0.5
+        }
+    )
+
+    if followup is None:
+        raise HTTPException(400, "Invalid text probe input payload")
+
+    cache_key, served, raw_output = followup_lookup("text", followup, TEXT_AGENT_URL)
+    if served is not None:
+        return served
+
+    if cache_key is not None:
+        print("RAW TEXT AGENT OUTPUT:\n", raw_output)
+        sys.stdout.flush()
+
+    parsed = safe_parse_json(raw_output)
+
+    concept = followup.concept
+
+    # HARD FALLBACK
+    if not isinstance(parsed, dict):
+        if not raw_output.strip():
+            followup_cache_put(cache_key, None)
+
+            banked = bank_pick(followup.session_id or STATE.get("session_id"), concept, "text")
+            if banked:
+                return {"question_type": "text", **banked}
+
+            return {
+                "question_type": "text",
+                "question": "Explain your reasoning step by step."
+            }
+
+        return {
             "question_type": "text",
             "question": raw_output.strip()
         }
 
-    return {
+    # NORMALIZATION
+    question = (
+        parsed.get("question")
+        or parsed.get("probe")
+        or parsed.get("prompt")
+        or parsed.get("text")
+    )
+
+    if not isinstance(question, str):
+        return {
+            "question_type": "text",
+            "question": raw_output.strip()
+        }
+
+    bank_add(concept, "text", question, difficulty=parsed.get("difficulty"))
+
+    result = {
         "question_type": "text",
         "question": question.strip()
     }
+    followup_cache_put(cache_key, result)
+
+    return result
 
 # ===========================
 # LOGGER (EXPLANATION DIAGNOSTICS)
@@ -855,36 +2838,26 @@ async def generate_text_probe(request: Request):
 LOGGER_RESULTS = {}
 
 @app.post("/logger/analyze")
+@json_endpoint
 async def run_logger(request: Request):
     """Analyzes session history to identify explanation gaps."""
-    raw = await request.body()
-
     # HARD NORMALIZATION
-    try:
-        body = json.loads(raw)
-    except Exception:
-        body = raw.decode()
-
-    # If body is string -> treat as session_id
-    if isinstance(body, str):
-        session_id = body
-    elif isinstance(body, dict):
-        session_id = body.get("session_id")
-    else:
-        session_id = None
+    logger_request = LoggerRequest.from_body(await parse_body(request))
 
-    if not isinstance(session_id, str):
+    if logger_request is None:
         # Never fail delivery
         return {
             "ok": False,
             "reason": "Missing session_id"
         }
 
+    session_id = logger_request.session_id
+
     # FETCH HISTORY INTERNALLY
-    session_history = SESSION_STORE.get(session_id, [])
+    session_history = [turn.to_dict() for turn in SESSION_STORE.get(session_id, [])]
 
     # Call LOGGER AGENT
-    response = requests.post(
+    response = post_agent(
         LOGGER_AGENT_URL,
         json={
             "session_id": session_id,
@@ -915,6 +2888,7 @@ async def run_logger(request: Request):
     }
 
 @app.post("/generate/logger/analyze")
+@json_endpoint
 async def run_logger_alias(request: Request):
     """Alias for running the logger analyze functionality."""
     return await run_logger(request)
@@ -925,58 +2899,313 @@ async def run_logger_alias(request: Request):
 # ===========================
 
 # Simple in-memory session store (demo / hackathon scope)
+# session_id → SessionRecord; reads like the old list of {"turn", "payload"} dicts
 SESSION_STORE = {}
 
+# -------- Compact turn storage --------
+# Turns are slotted records holding payload values in a tuple, with the
+# key tuple ("shape") shared across turns. Concept/role-style values are
+# interned and question texts pooled, so every session repeating a bank
+# question points at one string. Sessions with no new turn for
+# SESSION_IDLE_SECONDS are packed (background sweep, every
+# SESSION_SWEEP_INTERVAL) into one zlib blob that refers to pooled
+# texts and shapes by index; reads inflate a temporary copy, the next
+# append unpacks for good.
+
+SESSION_IDLE_SECONDS = 600
+SESSION_SWEEP_INTERVAL = 30         # seconds between idle sweeps (background job)
+SESSION_PACK_BATCH = 256            # sessions packed per loop turn, bounds the pause
+SESSION_POOL_MAX = 50000            # shared texts / shapes kept, per pool
+SESSION_INTERN_MAX_LEN = 64
+
+INTERNED_PAYLOAD_FIELDS = {
+    "concept", "concept_id", "role", "type", "question_type",
+    "mode", "understanding", "difficulty", "source", "status"
+}
+POOLED_PAYLOAD_FIELDS = {
+    "question", "base_question", "probe_question", "followup_question", "previous_question"
+}
+
+# Append-only pools: an index stays valid for the life of the process
+SESSION_TEXTS = []                  # pooled question texts
+SESSION_TEXT_IDS = {}               # text → index in SESSION_TEXTS
+SESSION_SHAPES = []                 # pooled payload key tuples
+SESSION_SHAPE_IDS = {}              # key tuple → index in SESSION_SHAPES
+
+SESSION_ACTIVE = OrderedDict()      # unpacked sessions, least recently appended first
+
+SESSION_MEMORY_STATS = {
+    "appends": 0,
+    "packed": 0,
+    "unpacked": 0,
+    "sweeps": 0
+}
+
+
+def _pool_id(ids: dict, items: list, value):
+    """Index of value in a shared pool, adding it while there is room (None when full)."""
+    index = ids.get(value)
+    if index is None and len(items) < SESSION_POOL_MAX:
+        index = ids[value] = len(items)
+        items.append(value)
+    return index
+
+
+def _pooled(ids: dict, items: list, value):
+    index = _pool_id(ids, items, value)
+    return value if index is None else items[index]
+
+
+def compact_payload(value):
+    """Copy of a JSON value with interned keys/labels and pooled question texts."""
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            if isinstance(key, str) and len(key) <= SESSION_INTERN_MAX_LEN:
+                key = sys.intern(key)
+
+            if isinstance(item, str):
+                if key in INTERNED_PAYLOAD_FIELDS and len(item) <= SESSION_INTERN_MAX_LEN:
+                    item = sys.intern(item)
+                elif key in POOLED_PAYLOAD_FIELDS:
+                    item = _pooled(SESSION_TEXT_IDS, SESSION_TEXTS, item)
+            elif isinstance(item, (dict, list)):
+                item = compact_payload(item)
+
+            out[key] = item
+        return out
+
+    if isinstance(value, list):
+        return [compact_payload(item) for item in value]
+
+    return value
+
+
+class SessionTurn:
+    """One stored turn. Supports the reads the old {"turn", "payload"} dict did."""
+
+    __slots__ = ("turn", "shape", "values")
+
+    def __init__(self, turn: int, shape: tuple, values: tuple):
+        self.turn = turn
+        self.shape = shape
+        self.values = values
+
+    @classmethod
+    def from_payload(cls, turn: int, payload: dict):
+        payload = compact_payload(payload)
+        return cls(
+            turn,
+            _pooled(SESSION_SHAPE_IDS, SESSION_SHAPES, tuple(payload)),
+            tuple(payload.values())
+        )
+
+    def packed(self) -> tuple:
+        """(turn, shape or shape index, pooled-text refs, values) for marshal."""
+        shape_id = SESSION_SHAPE_IDS.get(self.shape)
+        values = self.values
+        refs = []
+
+        for pos, key in enumerate(self.shape):
+            if key in POOLED_PAYLOAD_FIELDS and isinstance(values[pos], str):
+                text_id = SESSION_TEXT_IDS.get(values[pos])
+                if text_id is not None:
+                    refs.append((pos, text_id))
+
+        if refs:
+            values = list(values)
+            for pos, _ in refs:
+                values[pos] = None
+            values = tuple(values)
+
+        return (self.turn, self.shape if shape_id is None else shape_id, tuple(refs), values)
+
+    @classmethod
+    def unpacked(cls, row: tuple):
+        turn, shape, refs, values = row
+        if refs:
+            values = list(values)
+            for pos, text_id in refs:
+                values[pos] = SESSION_TEXTS[text_id]
+            values = tuple(values)
+        return cls(turn, SESSION_SHAPES[shape] if isinstance(shape, int) else shape, values)
+
+    @property
+    def payload(self) -> dict:
+        return dict(zip(self.shape, self.values))
+
+    def keys(self):
+        return ("turn", "payload")
+
+    def __getitem__(self, key):
+        if key == "turn":
+            return self.turn
+        if key == "payload":
+            return self.payload
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        return {"turn": self.turn, "payload": self.payload}
+
+
+class SessionRecord:
+    """A session's turns; iterable and sized like the old list, packed while idle."""
+
+    __slots__ = ("turns", "packed", "count", "touched")
+
+    def __init__(self):
+        self.turns = []
+        self.packed = None
+        self.count = 0
+        self.touched = time.monotonic()
+
+    def _inflate(self) -> list:
+        return [
+            SessionTurn.unpacked(row)
+            for row in marshal.loads(zlib.decompress(self.packed))
+        ]
+
+    def append(self, turn: int, payload: dict) -> None:
+        if self.packed is not None:
+            self.turns = self._inflate()
+            self.packed = None
+            SESSION_MEMORY_STATS["unpacked"] += 1
+
+        self.turns.append(SessionTurn.from_payload(turn, payload))
+        self.count += 1
+        self.touched = time.monotonic()
+
+    def pack(self) -> bool:
+        if self.packed is not None or not self.turns:
+            return False
+
+        try:
+            blob = marshal.dumps([t.packed() for t in self.turns])
+        except ValueError:
+            return False    # payload holds something marshal can't encode; stay unpacked
+
+        self.packed = zlib.compress(blob, 6)
+        self.turns = None
+        SESSION_MEMORY_STATS["packed"] += 1
+        return True
+
+    def __iter__(self):
+        return iter(self.turns if self.packed is None else self._inflate())
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return (self.turns if self.packed is None else self._inflate())[index]
+
+
+def pack_idle_sessions(now: float = None, limit: int = None) -> int:
+    """Packs up to limit sessions whose last append is older than SESSION_IDLE_SECONDS."""
+    now = time.monotonic() if now is None else now
+    packed = 0
+
+    while SESSION_ACTIVE and (limit is None or packed < limit):
+        session_id, record = next(iter(SESSION_ACTIVE.items()))
+        if now - record.touched < SESSION_IDLE_SECONDS:
+            break
+        SESSION_ACTIVE.popitem(last=False)
+        packed += record.pack()
+
+    SESSION_MEMORY_STATS["sweeps"] += 1
+    return packed
+
+
+@maintenance_job(SESSION_SWEEP_INTERVAL)
+async def sweep_idle_sessions() -> None:
+    """Packs every idle session, SESSION_PACK_BATCH per loop turn."""
+    while True:
+        pack_idle_sessions(limit=SESSION_PACK_BATCH)
+        oldest = next(iter(SESSION_ACTIVE.values()), None)
+        if oldest is None or time.monotonic() - oldest.touched < SESSION_IDLE_SECONDS:
+            return
+        await asyncio.sleep(0)
+
+
+@app.get("/session/memory/stats")
+@json_endpoint
+def session_memory_stats():
+    """Session store footprint: packed vs live sessions and shared-string pools."""
+    packed = [r.packed for r in SESSION_STORE.values() if r.packed is not None]
+    return {
+        **SESSION_MEMORY_STATS,
+        "sessions": len(SESSION_STORE),
+        "active_sessions": len(SESSION_ACTIVE),
+        "packed_sessions": len(packed),
+        "packed_bytes": sum(len(blob) for blob in packed),
+        "turns": sum(len(r) for r in SESSION_STORE.values()),
+        "shared_texts": len(SESSION_TEXTS),
+        "shared_shapes": len(SESSION_SHAPES)
+    }
+
+
 @app.post("/session/store")
+@json_endpoint
 async def store_session_turn(request: Request):
     """Stores individual conversation turns into the in-memory session store."""
-    raw = await request.body()
+    turn = SessionTurnRequest.from_body(await parse_body(request))
 
-    try:
-        body = json.loads(raw)
-    except Exception:
+    if turn is None or not append_session_turn(turn.session_id, turn.turn, turn.payload):
         return {"ok": False}
 
-    if not isinstance(body, dict):
-        return {"ok": False}
+    return {"ok": True}
 
-    session_id = body.get("session_id")
-    turn = body.get("turn")
-    payload = body.get("payload")
 
+def append_session_turn(session_id, turn, payload) -> bool:
+    """Validates and appends one turn. Shared by /session/store and bulk import."""
     # Hard validation (never crash)
     if not isinstance(session_id, str):
-        return {"ok": False}
+        return False
 
     if not isinstance(turn, int):
-        return {"ok": False}
+        return False
 
     if not isinstance(payload, dict):
-        return {"ok": False}
+        return False
 
     # Initialize session if needed
-    if session_id not in SESSION_STORE:
-        SESSION_STORE[session_id] = []
+    record = SESSION_STORE.get(session_id)
+    if record is None:
+        record = SESSION_STORE[session_id] = SessionRecord()
 
     # Enforce monotonic turn ordering (soft)
-    SESSION_STORE[session_id].append({
-        "turn": turn,
-        "payload": payload
-    })
+    record.append(turn, payload)
 
-    return {"ok": True}
+    SESSION_ACTIVE[session_id] = record
+    SESSION_ACTIVE.move_to_end(session_id)
+
+    SESSION_MEMORY_STATS["appends"] += 1
+
+    return True
 
 @app.post("/generate/session/store")
+@json_endpoint
 async def store_session_turn_alias(request: Request):
     """Alias for storing session turn data."""
     return await store_session_turn(request)
 
 @app.post("/exam/next")
+@json_endpoint
 def exam_next():
     phase = STATE["phase"]
 
     if phase == "idle":
-        requests.post(
+        retry_after = admit(STATE.get("session_id"), QUESTION_URL, "exam")
+        if retry_after:
+            return shed_response(retry_after)
+
+        expect_webhook("question")
+        post_agent(
             QUESTION_URL,
             json={"previous_topic": STATE.get("current_concept")},
             headers=HEADERS
@@ -1005,17 +3234,840 @@ def exam_next():
 
 
 
+# ===========================
+# COHORT EXAMS
+# ===========================
+# One diagnostic for a whole class: every student gets the same base
+# question per concept, answers arrive in bulk, and probe / stabilizer
+# calls fan out under a shared concurrency cap. Identical calls within a
+# cohort (same concept and normalized answer text) are made once and shared.
+# Cohort state lives here, not in STATE, so a live single-session exam is
+# never disturbed. One probe round per concept (no re-probe loop).
+
+COHORT_MAX_SESSIONS = 1000
+COHORT_MAX_CONCURRENCY = 8          # agent calls in flight across all cohorts
+COHORT_EVENTS_IDLE_TIMEOUT = 120    # seconds without progress before an event stream closes
+COHORT_RETENTION_SECONDS = 3600     # finished cohorts stay readable this long
+COHORT_ABANDON_SECONDS = 6 * 3600   # unfinished cohorts without progress are dropped after this
+COHORT_SWEEP_INTERVAL = 60
+
+COHORTS = {}                # cohort_id → cohort dict (see start_cohort)
+COHORT_EXECUTIONS = {}      # stabilizer execution ID → {"cohort_id", "targets", "verdict", "created_at"}
+COHORT_AGENT_SLOTS = asyncio.Semaphore(COHORT_MAX_CONCURRENCY)
+
+COHORT_STATS = {
+    "cohorts": 0,
+    "answers": 0,
+    "agent_calls": 0,
+    "deduplicated": 0,
+    "prescreened": 0,
+    "throttled": 0,
+    "failures": 0,
+    "expired": 0
+}
+
+
+def _cohort_entry(cohort, session_id, concept):
+    return cohort["students"].get(session_id, {}).get(concept)
+
+
+def _cohort_publish(cohort, event: dict) -> None:
+    for queue in cohort["listeners"]:
+        queue.put_nowait(event)
+
+
+def _cohort_done(cohort) -> bool:
+    return cohort["completed"] >= cohort["total"]
+
+
+def _cohort_complete_one(cohort) -> None:
+    cohort["completed"] += 1
+    cohort["updated_at"] = time.time()
+
+
+def _drop_cohort(cohort_id: str):
+    """Removes a cohort, cancels its steps and forgets its stabilizer executions."""
+    cohort = COHORTS.pop(cohort_id, None)
+    if cohort is None:
+        return None
+
+    for task in list(cohort["tasks"]):
+        task.cancel()
+    for execution_id in [k for k, v in COHORT_EXECUTIONS.items() if v["cohort_id"] == cohort_id]:
+        del COHORT_EXECUTIONS[execution_id]
+    return cohort
+
+
+@maintenance_job(COHORT_SWEEP_INTERVAL)
+def expire_cohorts(now: float = None) -> None:
+    """
+    Drops finished cohorts after COHORT_RETENTION_SECONDS and abandoned ones
+    after COHORT_ABANDON_SECONDS, plus execution entries nobody will claim:
+    those of finished or dropped cohorts and buffered early verdicts whose
+    step never registered.
+    """
+    now = time.time() if now is None else now
+
+    for cohort_id, cohort in list(COHORTS.items()):
+        keep = COHORT_RETENTION_SECONDS if _cohort_done(cohort) else COHORT_ABANDON_SECONDS
+        if now - cohort["updated_at"] > keep:
+            _drop_cohort(cohort_id)
+            COHORT_STATS["expired"] += 1
+
+    for execution_id, pending in list(COHORT_EXECUTIONS.items()):
+        cohort = COHORTS.get(pending["cohort_id"])
+        if (
+            cohort is None
+            or _cohort_done(cohort)
+            or now - pending["created_at"] > COHORT_ABANDON_SECONDS
+        ):
+            del COHORT_EXECUTIONS[execution_id]
+
+
+async def _cohort_call(cohort, key, session_id, url: str, payload: dict):
+    """
+    Makes one agent call per key per cohort; concurrent and later callers
+    with the same key share the response text (None on failure).
+    """
+    calls = cohort["calls"]
+    shared = calls.get(key)
+    if shared is not None:
+        COHORT_STATS["deduplicated"] += 1
+        return await asyncio.shield(shared)
+
+    shared = calls[key] = asyncio.get_running_loop().create_future()
+    text = None
+
+    try:
+        # Same buckets as interactive exams; wait instead of shedding, and
+        # before taking a slot so a throttled call doesn't hold one idle
+        retry_after = admit(session_id, url, "exam")
+        while retry_after:
+            COHORT_STATS["throttled"] += 1
+            await asyncio.sleep(retry_after)
+            retry_after = admit(session_id, url, "exam")
+
+        async with COHORT_AGENT_SLOTS:
+            COHORT_STATS["agent_calls"] += 1
+            # Only the HTTP call runs in the worker thread; the span is
+            # recorded back on the loop thread, which owns the trace stores
+            wall_start, perf_start = time.time(), time.perf_counter()
+            r = None
+            try:
+                r = await asyncio.to_thread(_post_agent_untraced, url, payload, HEADERS)
+            finally:
+                record_agent_span(url, payload, wall_start, perf_start, r)
+
+            if r.status_code < 400:
+                text = r.text
+    except Exception as e:
+        print("COHORT AGENT ERROR:", e)
+        sys.stdout.flush()
+
+    if text is None:
+        COHORT_STATS["failures"] += 1
+        calls.pop(key, None)     # let a later answer retry
+
+    shared.set_result(text)
+    return text
+
+
+async def cohort_probe_step(cohort, session_id, concept) -> None:
+    """Base answer → probe question for one student."""
+    entry = _cohort_entry(cohort, session_id, concept)
+    question = cohort["questions"][concept]
+    answer = entry["base_answer"]
+
+    screen = prescreen_answer(concept, question, answer)
+    if screen["verdict"]:
+        COHORT_STATS["prescreened"] += 1
+        probe_q = PRESCREEN_PROBES[screen["verdict"]].format(concept=concept)
+    else:
+        text = await _cohort_call(
+            cohort,
+            ("probe", concept, answer_key(answer)),
+            session_id,
+            PROBE_URL,
+            {
+                "concept": concept,
+                "previous_question": question,
+                "user_answer": answer
+            }
+        )
+        parsed = safe_parse_json(text) if text else None
+        probe_q = parsed.get("followup_question") if isinstance(parsed, dict) else None
+
+        if isinstance(probe_q, str) and probe_q.strip():
+            probe_q = probe_q.strip()
+            bank_add(concept, "probe", probe_q)
+        else:
+            banked = bank_pick(session_id, concept, "probe")
+            probe_q = banked["question"] if banked else "Explain your reasoning step by step."
+
+    entry["probe_question"] = probe_q
+    entry["stage"] = "probe"
+    _cohort_publish(cohort, {
+        "type": "probe",
+        "session_id": session_id,
+        "concept": concept,
+        "question": probe_q
+    })
+
+
+async def cohort_stabilize_step(cohort, session_id, concept) -> None:
+    """Probe answer → stability verdict for one student."""
+    entry = _cohort_entry(cohort, session_id, concept)
+    answer = entry["probe_answer"]
+
+    screen = prescreen_answer(concept, entry["probe_question"], answer, "probe")
+    if screen["verdict"]:
+        COHORT_STATS["prescreened"] += 1
+        cohort_apply_verdict(cohort, session_id, concept, {
+            "confidence": 0.2,
+            "gap_score": 0.8,
+            "understanding": "insufficient",
+            "failure_point": PRESCREEN_FAILURE_POINTS[screen["verdict"]],
+            "source": "prescreen"
+        })
+        return
+
+    text = await _cohort_call(
+        cohort,
+        (
+            "stabilizer",
+            concept,
+            answer_key(entry["base_answer"]),
+            " ".join(entry["probe_question"].lower().split()),
+            answer_key(answer)
+        ),
+        session_id,
+        STABILIZER_URL,
+        {
+            "base_question": cohort["questions"][concept],
+            "base_answer": entry["base_answer"],
+            "probe_question": entry["probe_question"],
+            "probe_answer": answer,
+            "concept_id": concept,
+            "session_id": session_id,
+            "cohort_id": cohort["cohort_id"]
+        }
+    )
+
+    parsed = safe_parse_json(text) if text else None
+
+    # Some deployments answer inline; the rest deliver to /stabilizer later
+    if isinstance(parsed, dict) and ("confidence" in parsed or "gap_score" in parsed):
+        cohort_apply_verdict(cohort, session_id, concept, parsed)
+        return
+
+    execution_id = parsed.get("executionID") if isinstance(parsed, dict) else None
+    if not execution_id:
+        entry["stage"] = "error"
+        _cohort_complete_one(cohort)
+        _cohort_publish(cohort, {"type": "error", "session_id": session_id, "concept": concept})
+        return
+
+    pending = COHORT_EXECUTIONS.setdefault(str(execution_id), {
+        "cohort_id": cohort["cohort_id"],
+        "targets": [],
+        "verdict": None,
+        "created_at": time.time()
+    })
+    if pending["verdict"] is not None:
+        cohort_apply_verdict(cohort, session_id, concept, pending["verdict"])
+    else:
+        pending["targets"].append((session_id, concept))
+
+
+def cohort_apply_verdict(cohort, session_id, concept, payload: dict) -> None:
+    """Stores a verdict for one student, records it for analytics and notifies listeners."""
+    entry = _cohort_entry(cohort, session_id, concept)
+    if entry is None or entry["stage"] != "analyzing":
+        return
+
+    try:
+        confidence, gap = stability_scores(payload)
+        scored = True
+    except (TypeError, ValueError):
+        confidence, gap = 0.5, 0.5
+        scored = False
+
+    mode, reason = decide_mode(gap, confidence, 2)
+    entry["verdict"] = {
+        "confidence": confidence,
+        "gap_score": gap,
+        "understanding": payload.get("understanding"),
+        "failure_point": payload.get("failure_point"),
+        "followup_type": mode,
+        "reason": reason
+    }
+    entry["stage"] = "done"
+    _cohort_complete_one(cohort)
+
+    if scored and payload.get("source") != "prescreen":
+        record_verdict(
+            concept,
+            confidence,
+            gap,
+            payload.get("understanding"),
+            payload.get("failure_point"),
+            session_id
+        )
+
+    _cohort_publish(cohort, {
+        "type": "verdict",
+        "session_id": session_id,
+        "concept": concept,
+        **entry["verdict"]
+    })
+
+
+def cohort_route_verdict(payload) -> bool:
+    """
+    Hands a stabilizer delivery to the cohort(s) waiting on its execution ID.
+    Returns True for every delivery that belongs to a cohort (matched by
+    execution ID, or tagged with cohort_id), so none of them ever reaches
+    the live exam. A tagged delivery that beats its step's registration
+    (the post runs in a worker thread) is buffered under its execution ID.
+    """
+    if not isinstance(payload, dict):
+        return False
+
+    execution_id = payload.get("executionID") or payload.get("execution_id")
+    execution_id = str(execution_id) if execution_id else None
+    pending = COHORT_EXECUTIONS.get(execution_id) if execution_id else None
+
+    if pending is None:
+        cohort_id = payload.get("cohort_id")
+        if not cohort_id:
+            return False
+
+        cohort = COHORTS.get(cohort_id)
+        if cohort is None or _cohort_done(cohort):
+            return True     # cohort gone or finished; drop rather than touch the live exam
+
+        if execution_id:
+            # Early delivery: cohort_stabilize_step applies it on registration
+            COHORT_EXECUTIONS[execution_id] = {
+                "cohort_id": cohort_id,
+                "targets": [],
+                "verdict": payload,
+                "created_at": time.time()
+            }
+        else:
+            cohort_apply_verdict(
+                cohort, payload.get("session_id"), normalize_concept(payload.get("concept_id")), payload
+            )
+        return True
+
+    # Kept so deduplicated students that register later still get it
+    pending["verdict"] = payload
+    cohort = COHORTS.get(pending["cohort_id"])
+    if cohort is not None:
+        for session_id, concept in pending["targets"]:
+            cohort_apply_verdict(cohort, session_id, concept, payload)
+    pending["targets"] = []
+    return True
+
+
+def cohort_results(cohort, session_ids=None) -> dict:
+    """Per-student stages/verdicts and per-concept aggregates, as far as they got."""
+    students = {}
+    concepts = {
+        concept: {
+            "students": 0,
+            "done": 0,
+            "confidence": [],
+            "gap_score": [],
+            "understanding": {},
+            "followup_type": {}
+        }
+        for concept in cohort["questions"]
+    }
+
+    for session_id, entries in cohort["students"].items():
+        view = {}
+        for concept, entry in entries.items():
+            agg = concepts[concept]
+            agg["students"] += 1
+
+            verdict = entry["verdict"]
+            if verdict is not None:
+                agg["done"] += 1
+                agg["confidence"].append(verdict["confidence"])
+                agg["gap_score"].append(verdict["gap_score"])
+                for field in ("understanding", "followup_type"):
+                    label = verdict[field] or "unknown"
+                    agg[field][label] = agg[field].get(label, 0) + 1
+
+            if session_ids is None or session_id in session_ids:
+                view[concept] = {
+                    "stage": entry["stage"],
+                    "question": (
+                        cohort["questions"][concept] if entry["stage"] == "base"
+                        else entry["probe_question"] if entry["stage"] == "probe"
+                        else None
+                    ),
+                    "verdict": verdict
+                }
+        if view:
+            students[session_id] = view
+
+    for agg in concepts.values():
+        conf = agg.pop("confidence")
+        gap = agg.pop("gap_score")
+        agg["mean_confidence"] = float(np.mean(conf)) if conf else None
+        agg["mean_gap_score"] = float(np.mean(gap)) if gap else None
+
+    return {
+        "ok": True,
+        "cohort_id": cohort["cohort_id"],
+        "completed": cohort["completed"],
+        "total": cohort["total"],
+        "done": _cohort_done(cohort),
+        "concepts": concepts,
+        "students": students
+    }
+
+
+def _get_cohort(cohort_id: str):
+    cohort = COHORTS.get(cohort_id)
+    if cohort is None:
+        raise HTTPException(404, "Unknown cohort")
+    return cohort
+
+
+@app.post("/cohort/start")
+@json_endpoint
+async def start_cohort(request: Request):
+    """Starts one exam for many sessions with a shared question per concept."""
+    try:
+        start = CohortStartRequest.from_body(await parse_body(request))
+    except Exception as e:
+        return {"ok": False, "reason": f"Invalid cohort: {str(e)}"}
+
+    if not start.session_ids:
+        return {"ok": False, "reason": "Missing session_ids"}
+
+    if len(start.session_ids) > COHORT_MAX_SESSIONS:
+        return {"ok": False, "reason": f"At most {COHORT_MAX_SESSIONS} sessions per cohort"}
+
+    concepts = list(dict.fromkeys(start.concepts or list(start.questions) or ["joins"]))
+
+    cohort_id = start.cohort_id or "cohort-" + hashlib.sha1(
+        f"{time.time()}:{','.join(start.session_ids)}".encode()
+    ).hexdigest()[:12]
+    if cohort_id in COHORTS:
+        return {"ok": False, "reason": "Cohort already exists"}
+
+    # Picked once for everyone: no per-student question generation
+    questions = {}
+    for concept in concepts:
+        question = start.questions.get(concept)
+        if not question:
+            banked = bank_pick(cohort_id, concept, "base")
+            question = banked["question"] if banked else None
+        if not question:
+            return {"ok": False, "reason": f"No question available for {concept}"}
+        questions[concept] = question
+
+    COHORTS[cohort_id] = {
+        "cohort_id": cohort_id,
+        "questions": questions,
+        "students": {
+            session_id: {
+                concept: {
+                    "stage": "base",    # base | probing | probe | analyzing | done | error
+                    "base_answer": None,
+                    "probe_question": None,
+                    "probe_answer": None,
+                    "verdict": None
+                }
+                for concept in concepts
+            }
+            for session_id in start.session_ids
+        },
+        "calls": {},            # dedup key → future of the shared response text
+        "tasks": set(),
+        "listeners": set(),
+        "completed": 0,
+        "total": len(start.session_ids) * len(concepts),
+        "started_at": time.time(),
+        "updated_at": time.time()      # last answer or completion; drives expiry
+    }
+    COHORT_STATS["cohorts"] += 1
+
+    return {
+        "ok": True,
+        "cohort_id": cohort_id,
+        "sessions": len(start.session_ids),
+        "questions": questions
+    }
+
+
+@app.post("/cohort/{cohort_id}/answers")
+@json_endpoint
+async def submit_cohort_answers(cohort_id: str, request: Request):
+    """
+    Accepts base or probe answers for many students at once. The step each
+    answer triggers runs in the background; follow progress on /results or
+    /events.
+    """
+    cohort = _get_cohort(cohort_id)
+    answers = CohortAnswer.list_from_body(await parse_body(request))
+    if not answers:
+        return {"ok": False, "reason": "Missing answers"}
+
+    accepted = 0
+    rejected = []
+
+    only_concept = next(iter(cohort["questions"])) if len(cohort["questions"]) == 1 else None
+
+    for row in answers:
+        if row.concept not in cohort["questions"] and only_concept:
+            row.concept = only_concept
+        entry = _cohort_entry(cohort, row.session_id, row.concept)
+
+        if entry is None or not row.answer:
+            rejected.append({"session_id": row.session_id, "concept": row.concept, "reason": "unknown"})
+            continue
+
+        if entry["stage"] == "base":
+            entry["base_answer"] = row.answer
+            entry["stage"] = "probing"
+            step = cohort_probe_step
+        elif entry["stage"] == "probe":
+            entry["probe_answer"] = row.answer
+            entry["stage"] = "analyzing"
+            step = cohort_stabilize_step
+        else:
+            rejected.append({"session_id": row.session_id, "concept": row.concept, "reason": entry["stage"]})
+            continue
+
+        task = asyncio.create_task(step(cohort, row.session_id, row.concept))
+        cohort["tasks"].add(task)
+        task.add_done_callback(cohort["tasks"].discard)
+        accepted += 1
+
+    COHORT_STATS["answers"] += accepted
+    cohort["updated_at"] = time.time()
+    return {"ok": True, "accepted": accepted, "rejected": rejected}
+
+
+@app.get("/cohort/{cohort_id}/results")
+@json_endpoint
+def get_cohort_results(cohort_id: str, session_id: list[str] = Query(None)):
+    return cohort_results(_get_cohort(cohort_id), set(session_id) if session_id else None)
+
+
+async def relay_cohort_events(cohort):
+    """Yields SSE events for probes and verdicts as they complete."""
+    queue = asyncio.Queue()
+    cohort["listeners"].add(queue)
+
+    try:
+        yield _sse({"completed": cohort["completed"], "total": cohort["total"]}, "start")
+
+        while not _cohort_done(cohort):
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=COHORT_EVENTS_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                yield _sse({}, "timeout")
+                return
+
+            yield _sse(event, event["type"])
+
+        yield _sse(cohort_results(cohort, set())["concepts"], "done")
+    finally:
+        cohort["listeners"].discard(queue)
+
+
+@app.get("/cohort/{cohort_id}/events")
+async def cohort_events(cohort_id: str):
+    return StreamingResponse(
+        relay_cohort_events(_get_cohort(cohort_id)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.delete("/cohort/{cohort_id}")
+@json_endpoint
+async def delete_cohort(cohort_id: str):
+    # async: cancels the cohort's tasks, which must happen on the loop thread
+    return {"ok": _drop_cohort(cohort_id) is not None}
+
+
+@app.get("/cohort/stats")
+@json_endpoint
+def cohort_stats():
+    return {
+        **COHORT_STATS,
+        "active": len(COHORTS),
+        "pending_executions": len(COHORT_EXECUTIONS)
+    }
+
+
+
+# ===========================
+# SESSION EXPORT / IMPORT / REPLAY
+# ===========================
+# NDJSON line format (same shape as /session/store):
+#   {"session_id": "...", "turn": 1, "payload": {...}}
+
+def _iter_session_lines(session_ids=None, prefix=None):
+    """Yields one NDJSON line per stored turn without building the full export."""
+    ids = session_ids if session_ids else list(SESSION_STORE.keys())
+
+    for session_id in ids:
+        if prefix and not session_id.startswith(prefix):
+            continue
+
+        for turn in SESSION_STORE.get(session_id, []):
+            yield json_dumps_bytes({
+                "session_id": session_id,
+                "turn": turn.get("turn"),
+                "payload": turn.get("payload")
+            }) + b"\n"
+
+
+async def _iter_ndjson(request: Request):
+    """Parses a streamed NDJSON request body one line at a time."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+@app.get("/session/export")
+def export_sessions(session_id: list[str] = Query(None), prefix: str = None):
+    """Streams all (or the selected) sessions as NDJSON."""
+    return StreamingResponse(
+        _iter_session_lines(session_id, prefix),
+        media_type="application/x-ndjson"
+    )
+
+
+@app.post("/session/import")
+@json_endpoint
+async def import_sessions(request: Request):
+    """Bulk-loads NDJSON turns into the session store."""
+    imported = 0
+    skipped = 0
+
+    async for line in _iter_ndjson(request):
+        try:
+            row = json_loads(line)
+        except Exception:
+            skipped += 1
+            continue
+
+        if isinstance(row, dict) and append_session_turn(
+            row.get("session_id"), row.get("turn"), row.get("payload")
+        ):
+            imported += 1
+        else:
+            skipped += 1
+
+    return {"ok": True, "imported": imported, "skipped": skipped}
+
+
+class _StubResponse:
+    """Minimal stand-in for requests.Response."""
+
+    def __init__(self, data: dict):
+        self.status_code = 200
+        self.text = json.dumps(data)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def agent_stub_post(url: str, payload=None):
+    """Deterministic local agent stub used during replay."""
+    concept = (payload or {}).get("concept") or STATE.get("current_concept")
+
+    if url == PROBE_URL:
+        return _StubResponse({"followup_question": f"Why does your answer hold for {concept}?"})
+
+    if url in (MCQ_AGENT_URL, "http://127.0.0.1:8000/generate/mcq"):
+        return _StubResponse({
+            "question_type": "mcq",
+            "question": f"Which statement about {concept} is correct?",
+            "options": {"A": "Stub A", "B": "Stub B", "C": "Stub C", "D": "Stub D"}
+        })
+
+    if url in (TEXT_AGENT_URL, "http://127.0.0.1:8000/generate/text"):
+        return _StubResponse({
+            "question_type": "text",
+            "question": f"Explain {concept} in your own words."
+        })
+
+    if url == LOGGER_AGENT_URL:
+        return _StubResponse({"diagnosis": [], "summary": "stub"})
+
+    # Webhook-driven workflows (question, stabilizer, chat, media) just ack
+    return _StubResponse({"executionID": "replay-stub"})
+
+
+def _local_request(path: str, body) -> Request:
+    """Builds an in-process POST request so handlers can be driven directly."""
+    raw = body if isinstance(body, bytes) else json.dumps(body).encode()
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {"type": "http.disconnect"}
+        sent = True
+        return {"type": "http.request", "body": raw, "more_body": False}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": path,
+        "headers": [(b"content-type", b"application/json")],
+        "query_string": b""
+    }
+    return Request(scope, receive)
+
+
+_STATE_DEFAULTS = dict(STATE)
+
+REPLAY_ENDPOINTS = {
+    "/question": lambda request: question_webhook(request),
+    "/answer": lambda request: submit_answer(request),
+    "/stabilizer": lambda request: stabilizer_webhook(request)
+}
+
+
+async def replay_session(session_id: str, turns: list, timings: dict) -> dict:
+    """
+    Pushes one recorded session back through the exam flow.
+    Payload keys select the path: "question" → /question,
+    "answer" → /answer, "confidence"/"gap_score" → /stabilizer and the
+    heuristic engine. Other turns are skipped.
+    """
+    STATE.clear()
+    STATE.update(_STATE_DEFAULTS, session_id=session_id, awaiting={})
+
+    decisions = []
+    pushed = 0
+
+    for turn in sorted(turns, key=lambda t: t.get("turn") if isinstance(t.get("turn"), int) else 0):
+        payload = turn.get("payload") or {}
+
+        if payload.get("concept"):
+            STATE["current_concept"] = normalize_concept(payload["concept"])
+
+        calls = []
+        if isinstance(payload.get("question"), str):
+            calls.append(("/question", {"question": payload["question"]}))
+        if isinstance(payload.get("answer"), str):
+            calls.append(("/answer", {"answer": payload["answer"]}))
+        if "confidence" in payload or "gap_score" in payload:
+            calls.append(("/stabilizer", dict(payload, session_id=session_id)))
+
+        for path, body in calls:
+            if path == "/question":
+                expect_webhook("question")   # recorded delivery stands in for the agent
+            started = time.perf_counter()
+            await REPLAY_ENDPOINTS[path](_local_request(path, body))
+            timings[path] = timings.get(path, 0.0) + (time.perf_counter() - started)
+            pushed += 1
+
+        if "confidence" in payload or "gap_score" in payload:
+            try:
+                confidence, gap = stability_scores(payload)
+            except Exception:
+                continue
+            mode, _ = decide_mode(gap, confidence, turn.get("turn") or 0)
+            decisions.append(mode)
+
+    return {
+        "session_id": session_id,
+        "turns": len(turns),
+        "pushed": pushed,
+        "final_phase": STATE["phase"],
+        "decisions": decisions
+    }
+
+
+@app.post("/session/replay")
+@json_endpoint
+async def replay_sessions(request: Request, session_id: list[str] = Query(None)):
+    """
+    Replays NDJSON sessions (request body) or, with an empty body, the stored
+    sessions, against the local agent stub. Only served when
+    FUD_REPLAY_ENABLED=1: the stub is process-wide, so a live exam running
+    alongside would see it too.
+    """
+    if not REPLAY_ENABLED:
+        raise HTTPException(403, "Replay is disabled; set FUD_REPLAY_ENABLED=1 on an offline instance")
+
+    sessions = {}
+    async for line in _iter_ndjson(request):
+        try:
+            row = json_loads(line)
+        except Exception:
+            continue
+        if isinstance(row, dict) and isinstance(row.get("session_id"), str):
+            sessions.setdefault(row["session_id"], []).append(row)
+
+    if not sessions:
+        ids = session_id if session_id else list(SESSION_STORE.keys())
+        sessions = {sid: SESSION_STORE.get(sid, []) for sid in ids}
+
+    # Live state is saved and restored; the shared stores (verdicts, bank,
+    # follow-up cache, traces, pre-screen counters) skip writes while the
+    # stub is active
+    saved_state = dict(STATE)
+    saved_cursors = dict(QUESTION_BANK_CURSORS)
+    AGENT_STUB["active"] = True
+    timings = {}
+    started = time.perf_counter()
+
+    try:
+        results = [
+            await replay_session(sid, turns, timings)
+            for sid, turns in sessions.items()
+        ]
+    finally:
+        AGENT_STUB["active"] = False
+        STATE.clear()
+        STATE.update(saved_state)
+        QUESTION_BANK_CURSORS.clear()
+        QUESTION_BANK_CURSORS.update(saved_cursors)
+
+    return {
+        "ok": True,
+        "sessions": len(results),
+        "turns": sum(r["turns"] for r in results),
+        "elapsed_ms": (time.perf_counter() - started) * 1000,
+        "endpoint_ms": {path: t * 1000 for path, t in timings.items()},
+        "results": results
+    }
+
+
+
 # ===========================
 # STATUS / RESULT
 # ===========================
 
 @app.get("/result")
+@json_endpoint
 def get_result():
     """Retrieves the latest stability verdict result."""
     return STATE["stability_result"] or {"status": "no result yet"}
 
 
 @app.get("/status")
+@json_endpoint
 def status():
     """Retrieves current phase and concept state."""
     return {